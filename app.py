@@ -1,20 +1,448 @@
 #!flask/bin/python
-from flask import Flask, jsonify, request, make_response, Response, abort
+from flask import Flask, json, request, make_response, Response, abort, stream_with_context, g
 from flask_pymongo import PyMongo
-from datetime import datetime
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, ReadPreference, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
+from cache import create_cache
+from compression import available_encodings, compress, compress_stream
+from monitoring import CommandStats, PoolStats, RequestMetrics
+import threading
+import click
+import zlib
+import bson
 import os
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 app = Flask(__name__)
 
 app.config['MONGO_DBNAME'] = 'restdb'
-if os.environ.get('DB_ENV_MONGO_VERSION'):
+if os.environ.get('MONGO_URI'):
+    app.config['MONGO_URI'] = os.environ['MONGO_URI']
+elif os.environ.get('DB_ENV_MONGO_VERSION'):
     app.config['MONGO_URI'] = 'mongodb://db:27017/notes'
 else:
     app.config['MONGO_URI'] = 'mongodb://localhost:27017/notes'
+# builds any missing indexes in the background once the first request is served
+app.config['ENSURE_INDEXES'] = os.environ.get('ENSURE_INDEXES', '1') == '1'
+# number of ids each worker reserves from the counters collection at a time
+app.config['ID_BLOCK_SIZE'] = int(os.environ.get('ID_BLOCK_SIZE', 1))
+# largest page that can be requested with ?limit= on the list routes
+app.config['MAX_PAGE_SIZE'] = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+# number of search results returned when no ?limit= is given
+app.config['SEARCH_PAGE_SIZE'] = int(os.environ.get('SEARCH_PAGE_SIZE', 20))
+# number of documents written to a streamed response at a time
+app.config['STREAM_CHUNK_SIZE'] = int(os.environ.get('STREAM_CHUNK_SIZE', 100))
+# largest number of notes accepted by a single POST /note/bulk request
+app.config['BULK_MAX_NOTES'] = int(os.environ.get('BULK_MAX_NOTES', 10000))
+# largest request body in bytes, larger bodies get a 413 status
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 64 * 1024 * 1024))
+# number of notes removed per delete when a notebook is deleted
+app.config['DELETE_BATCH_SIZE'] = int(os.environ.get('DELETE_BATCH_SIZE', 1000))
+# seconds without progress after which a running background job is taken to
+# have lost its worker and is resumed by another
+app.config['JOB_STALE_SECONDS'] = int(os.environ.get('JOB_STALE_SECONDS', 60))
+# background delete jobs each process runs at once, each holding a thread and
+# a database connection; jobs beyond it wait and are started once they go stale
+app.config['MAX_DELETE_JOBS'] = int(os.environ.get('MAX_DELETE_JOBS', 2))
+# cache for single note and notebook responses: 'memory', 'redis' or 'none'
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'memory')
+app.config['CACHE_URL'] = os.environ.get('CACHE_URL', 'redis://localhost:6379/0')
+app.config['CACHE_MAX_SIZE'] = int(os.environ.get('CACHE_MAX_SIZE', 10000))
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 5))
+# encodes responses with orjson, which requirements.txt installs, set to 0 to use Flask's encoder
+app.config['FAST_JSON'] = orjson is not None and os.environ.get('FAST_JSON', '1') == '1'
+# compresses responses of at least COMPRESS_MIN_SIZE bytes with the best
+# encoding the client accepts, set COMPRESSION to 0 to turn it off
+app.config['COMPRESSION'] = os.environ.get('COMPRESSION', '1') == '1'
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_LEVELS'] = {
+    'gzip': int(os.environ.get('COMPRESS_GZIP_LEVEL', 6)),
+    'br': int(os.environ.get('COMPRESS_BROTLI_LEVEL', 4)),
+    'zstd': int(os.environ.get('COMPRESS_ZSTD_LEVEL', 3)),
+}
+# changes newer than this are returned by GET /note/changes without moving its
+# sync token past them yet, so writes still in flight are not skipped
+app.config['SYNC_SETTLE_MS'] = int(os.environ.get('SYNC_SETTLE_MS', 1000))
+# days deleted notes are remembered for GET /note/changes, older sync tokens
+# are refused so their clients sync again from the start
+app.config['SYNC_RETENTION_DAYS'] = int(os.environ.get('SYNC_RETENTION_DAYS', 30))
+# number of most used tags listed with each notebook by GET /notebook
+app.config['TOP_TAGS'] = int(os.environ.get('TOP_TAGS', 5))
+# records request latency, response sizes and database commands per route for
+# GET /metrics, set METRICS to 0 to turn it off
+app.config['METRICS'] = os.environ.get('METRICS', '1') == '1'
+# database commands taking at least this many milliseconds are logged
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 100))
+# where the async server's note events for GET /note/events come from:
+# 'changestream' (the writes of every process, needs a replica set) or 'local'
+# (only the writes of the same process, for tests)
+app.config['EVENTS_BACKEND'] = os.environ.get('EVENTS_BACKEND', 'changestream')
+# seconds between keepalive comments on an idle event stream
+app.config['EVENTS_HEARTBEAT'] = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+# events held for a slow subscriber before its stream is closed
+app.config['EVENTS_QUEUE_SIZE'] = int(os.environ.get('EVENTS_QUEUE_SIZE', 1000))
+# connections each process may open to the database, the gunicorn config sets
+# this to the number of threads per worker
+app.config['MONGO_MAX_POOL_SIZE'] = int(os.environ.get('MONGO_MAX_POOL_SIZE', 100))
+# read preference of the routes that only read: primary, primaryPreferred,
+# secondary, secondaryPreferred or nearest
+app.config['MONGO_READ_PREFERENCE'] = os.environ.get('MONGO_READ_PREFERENCE', 'primary')
+
+# client options read from the environment, as (variable, option, type);
+# options whose variable is not set keep PyMongo's defaults
+MONGO_OPTIONS = [
+    ('MONGO_MIN_POOL_SIZE', 'minPoolSize', int),
+    ('MONGO_MAX_IDLE_TIME_MS', 'maxIdleTimeMS', int),
+    ('MONGO_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS', int),
+    ('MONGO_CONNECT_TIMEOUT_MS', 'connectTimeoutMS', int),
+    ('MONGO_SOCKET_TIMEOUT_MS', 'socketTimeoutMS', int),
+    ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS', int),
+    ('MONGO_WRITE_CONCERN', 'w', lambda value: int(value) if value.isdigit() else value),
+    ('MONGO_WRITE_TIMEOUT_MS', 'wtimeout', int),
+    ('MONGO_JOURNAL', 'journal', lambda value: value == '1'),
+    ('MONGO_RETRY_WRITES', 'retryWrites', lambda value: value == '1'),
+]
+for variable, option, kind in MONGO_OPTIONS:
+    if os.environ.get(variable):
+        app.config[variable] = kind(os.environ[variable])
+
+READ_PREFERENCES = {
+    'primary': ReadPreference.PRIMARY,
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondary': ReadPreference.SECONDARY,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+    'nearest': ReadPreference.NEAREST,
+}
+
+def mongo_options():
+    options = {'maxPoolSize': app.config['MONGO_MAX_POOL_SIZE']}
+    for variable, option, kind in MONGO_OPTIONS:
+        if variable in app.config:
+            options[option] = app.config[variable]
+    return options
+
+NOTE_FIELDS = ('nid', 'title', 'nbid', 'body', 'tags', 'created', 'lastModified')
+
+# a note document, the one representation every route reads, writes and
+# returns notes as, with its fields kept in NOTE_FIELDS order
+class Note(dict):
+    __slots__ = ()
 
-mongo = PyMongo(app)
+    @classmethod
+    def new(cls, nid, title, nbid, body, tags, time):
+        return cls((
+            ('nid', nid),
+            ('title', title),
+            ('nbid', nbid),
+            ('body', body),
+            ('tags', tags),
+            ('created', time),
+            ('lastModified', time),
+        ))
+
+pool_stats = PoolStats()
+command_stats = CommandStats(app.logger, app.config['SLOW_QUERY_MS'])
+request_metrics = RequestMetrics()
+mongo = PyMongo(app, event_listeners=[pool_stats] + ([command_stats] if app.config['METRICS'] else []), **mongo_options())
 notebooks = mongo.db.notebooks
-notes = mongo.db.notes
+# notes are decoded straight into Note records rather than plain dicts
+notes = mongo.db.notes.with_options(codec_options=mongo.db.codec_options.with_options(document_class=Note))
+counters = mongo.db.counters
+jobs = mongo.db.jobs
+tag_counts = mongo.db.tag_counts
+# a record of each deleted note, kept for GET /note/changes
+deleted_notes = mongo.db.deleted_notes
+# the collections as seen by the routes that only read, which may be served by
+# secondaries depending on MONGO_READ_PREFERENCE
+read_preference = READ_PREFERENCES[app.config['MONGO_READ_PREFERENCE']]
+read_notebooks = notebooks.with_options(read_preference=read_preference)
+read_notes = notes.with_options(read_preference=read_preference)
+read_tag_counts = tag_counts.with_options(read_preference=read_preference)
+# the notes as undecoded BSON, for clients that accept application/bson
+raw_notes = read_notes.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+cache = create_cache(app.config['CACHE_BACKEND'], app.config['CACHE_URL'], app.config['CACHE_MAX_SIZE'], app.config['CACHE_TTL'])
+
+# hands out ids from a counter document in the counters collection, which is
+# incremented atomically so concurrent workers never receive the same id
+class IdAllocator(object):
+    def __init__(self, collection, field, block_size=1):
+        self.collection = collection
+        self.field = field
+        self.block_size = max(block_size, 1)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.next_id = 0
+        self.last_id = -1
+        self.seeded = False
+
+    # the find_one arguments reading the highest id already stored, skipping
+    # documents written before the field existed, such as notes without a seq
+    def latest_query(self):
+        return {'filter': {self.field: {'$exists': True}}, 'sort': [(self.field, -1)], 'projection': {self.field: True}}
+
+    # the update moving the counter up to the id of latest, the document read
+    # with latest_query
+    def seed_update(self, latest):
+        return {'_id': self.field}, {'$max': {'seq': latest[self.field]}}
+
+    # the find_one_and_update arguments reserving count ids from the counter
+    def take_update(self, count):
+        return {'filter': {'_id': self.field}, 'update': {'$inc': {'seq': count}}, 'upsert': True, 'return_document': ReturnDocument.AFTER}
+
+    def block_empty(self):
+        return self.next_id > self.last_id
+
+    # hands out the next id of the local block, first starting a new block at
+    # first_id when one was just reserved from the counter
+    def from_block(self, first_id=None):
+        if first_id is not None:
+            self.next_id = first_id
+            self.last_id = first_id + self.block_size - 1
+        new_id = self.next_id
+        self.next_id += 1
+        return new_id
+
+    # starts the counter from the highest id already stored, so existing
+    # databases keep counting from where the old max() lookup left off
+    def seed(self):
+        latest = self.collection.find_one(**self.latest_query())
+        if latest:
+            try:
+                counters.update_one(*self.seed_update(latest), upsert=True)
+            except DuplicateKeyError:
+                counters.update_one(*self.seed_update(latest))
+        self.seeded = True
+
+    # reserves count ids from the counter and returns the first one
+    def take(self, count):
+        if not self.seeded:
+            self.seed()
+        counter = counters.find_one_and_update(**self.take_update(count))
+        return counter['seq'] - count + 1
+
+    # returns the first id of a contiguous range of count ids; single ids
+    # are served from a locally reserved block when block_size is above 1
+    def reserve(self, count=1):
+        with self.lock:
+            if count > 1 or self.block_size == 1:
+                return self.take(count)
+            if self.block_empty():
+                return self.from_block(self.take(self.block_size))
+            return self.from_block()
+
+notebook_ids = IdAllocator(notebooks, 'nbid', app.config['ID_BLOCK_SIZE'])
+note_ids = IdAllocator(notes, 'nid', app.config['ID_BLOCK_SIZE'])
+job_ids = IdAllocator(jobs, 'jobid')
+# numbers every change to a note in the order it was made, never in blocks so
+# the numbers follow the order of the writes across workers
+change_seqs = IdAllocator(notes, 'seq')
+
+# drops the connections and reserved ids a worker inherits from the process
+# that loaded the app before forking, so no two workers share a socket or id
+def reset_after_fork():
+    mongo.cx.close()
+    pool_stats.reset()
+    request_metrics.reset()
+    for allocator in (notebook_ids, note_ids, job_ids, change_seqs):
+        allocator.reset()
+
+# indexes required by the routes below, keyed by collection
+INDEXES = {
+    'notebooks': [
+        ([('nbid', ASCENDING)], {'name': 'nbid', 'unique': True}),
+    ],
+    'notes': [
+        ([('nid', ASCENDING)], {'name': 'nid', 'unique': True}),
+        ([('nbid', ASCENDING), ('nid', ASCENDING)], {'name': 'nbid_nid'}),
+        ([('nbid', ASCENDING), ('tags', ASCENDING)], {'name': 'nbid_tags'}),
+        ([('lastModified', ASCENDING)], {'name': 'lastModified'}),
+        ([('seq', ASCENDING)], {'name': 'seq'}),
+        ([('title', TEXT), ('tags', TEXT), ('body', TEXT)], {'name': 'text', 'weights': {'title': 10, 'tags': 5, 'body': 1}}),
+    ],
+    'tag_counts': [
+        ([('nbid', ASCENDING), ('tag', ASCENDING)], {'name': 'nbid_tag', 'unique': True}),
+        ([('nbid', ASCENDING), ('count', DESCENDING)], {'name': 'nbid_count'}),
+    ],
+    'jobs': [
+        ([('jobid', ASCENDING)], {'name': 'jobid', 'unique': True}),
+    ],
+    'deleted_notes': [
+        ([('seq', ASCENDING)], {'name': 'seq', 'unique': True}),
+    ],
+}
+
+# the queries the routes run, used to report whether each one is served by an index
+QUERIES = [
+    ('GET /notebook', 'notebooks', {'nbid': {'$gt': 0}}, [('nbid', ASCENDING)]),
+    ('GET /notebook/<nbid>', 'notebooks', {'nbid': 1}, None),
+    ('GET /notebook/<nbid> notes', 'notes', {'nbid': 1, 'nid': {'$gt': 0}}, [('nid', ASCENDING)]),
+    ('GET /notebook/<nbid>/<tag> notes', 'notes', {'nbid': 1, 'tags': 'tag'}, [('nid', ASCENDING)]),
+    ('GET /notebook/<nbid>/<tag>?match=any notes', 'notes', {'nbid': 1, 'tags': {'$in': ['tag', 'other']}}, [('nid', ASCENDING)]),
+    ('GET /notebook/<nbid>/<tag>?match=all notes', 'notes', {'nbid': 1, 'tags': {'$all': ['tag', 'other']}}, [('nid', ASCENDING)]),
+    ('GET /note', 'notes', {'nid': {'$gt': 0}}, [('nid', ASCENDING)]),
+    ('GET /note/<nid>', 'notes', {'nid': 1}, None),
+    ('GET /note/search', 'notes', {'$text': {'$search': 'word'}}, None),
+    ('GET /note/search?nbid=', 'notes', {'$text': {'$search': 'word'}, 'nbid': 1}, None),
+    ('GET /tags', 'tag_counts', {'nbid': None}, [('count', DESCENDING)]),
+    ('GET /tags?nbid=', 'tag_counts', {'nbid': 1}, [('count', DESCENDING)]),
+    ('GET /note/changes', 'notes', {'seq': {'$gt': 0}}, [('seq', ASCENDING)]),
+    ('GET /note/changes deletions', 'deleted_notes', {'seq': {'$gt': 0}}, [('seq', ASCENDING)]),
+    ('POST /note next nid', 'notes', {}, [('nid', DESCENDING)]),
+    ('POST /notebook next nbid', 'notebooks', {}, [('nbid', DESCENDING)]),
+]
+
+def ensure_indexes(background=False):
+    for name, indexes in INDEXES.items():
+        mongo.db[name].create_indexes([IndexModel(keys, background=background, **options) for keys, options in indexes])
+
+# the indexes in INDEXES that do not exist yet, as (collection, keys, options)
+def missing_indexes():
+    missing = []
+    for name, indexes in INDEXES.items():
+        existing = mongo.db[name].index_information()
+        missing.extend((name, keys, options) for keys, options in indexes if options['name'] not in existing)
+    return missing
+
+# builds indexes one at a time without blocking reads and writes, logging the
+# ones that cannot be built, e.g. a unique index over duplicate ids, instead
+# of raising
+def build_indexes(indexes):
+    for name, keys, options in indexes:
+        try:
+            mongo.db[name].create_indexes([IndexModel(keys, background=True, **options)])
+        except PyMongoError as e:
+            app.logger.warning('could not build index %s on %s, see flask create-indexes: %s', options['name'], name, e)
+
+# starts building missing indexes in a background thread, so no request waits
+# on them and a build that fails does not stop the app from serving; blocking
+# builds are left to flask create-indexes --foreground
+@app.before_first_request
+def ensure_indexes_on_startup():
+    if not app.config['ENSURE_INDEXES']:
+        return
+    try:
+        missing = missing_indexes()
+    except PyMongoError as e:
+        app.logger.warning('could not check indexes: %s', e)
+        return
+    if missing:
+        app.logger.warning('building missing indexes in the background: %s', ', '.join(options['name'] for name, keys, options in missing))
+        threading.Thread(target=build_indexes, args=(missing,), daemon=True).start()
+
+# returns the stages of a query plan from the top stage down
+def plan_stages(plan):
+    stages = [plan]
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            stages.extend(plan_stages(child))
+    return stages
+
+def index_report():
+    report = []
+    for route, name, query, sort in QUERIES:
+        cursor = mongo.db[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        index_names = [stage['indexName'] for stage in stages if 'indexName' in stage]
+        report.append({
+            'route': route,
+            'collection': name,
+            'covered': bool(index_names) and not any(stage['stage'] == 'COLLSCAN' for stage in stages),
+            'indexes': index_names
+        })
+    return report
+
+# command for building the indexes without blocking reads and writes
+@app.cli.command('create-indexes')
+@click.option('--foreground', is_flag=True, help='Build the indexes in the foreground.')
+def create_indexes_command(foreground):
+    ensure_indexes(background=not foreground)
+    for name, indexes in INDEXES.items():
+        click.echo('{}: {}'.format(name, ', '.join(options['name'] for keys, options in indexes)))
+
+# counts how many notes carry each tag in each notebook, straight from the notes
+# collection, and replaces the maintained counts with the result and its totals
+# across all notebooks
+def rebuild_tag_counts():
+    notes.aggregate([
+        {'$project': {'nbid': True, 'tags': {'$setUnion': ['$tags', []]}}},
+        {'$unwind': '$tags'},
+        {'$match': {'tags': {'$type': 'string'}}},
+        {'$group': {'_id': {'nbid': '$nbid', 'tag': '$tags'}, 'count': {'$sum': 1}}},
+        {'$project': {'_id': False, 'nbid': '$_id.nbid', 'tag': '$_id.tag', 'count': True}},
+        {'$out': 'tag_counts'},
+    ])
+    totals = list(tag_counts.aggregate([
+        {'$group': {'_id': '$tag', 'count': {'$sum': '$count'}}},
+        {'$project': {'_id': False, 'nbid': {'$literal': None}, 'tag': '$_id', 'count': True}},
+    ]))
+    if totals:
+        tag_counts.insert_many(totals)
+
+# sets the note count and top tags of every notebook from the notes and tag
+# counts stored, for notebooks written before they were kept up to date
+def rebuild_notebook_summaries():
+    note_counts = dict((entry['_id'], entry['count']) for entry in notes.aggregate([{'$group': {'_id': '$nbid', 'count': {'$sum': 1}}}]))
+    requests = [UpdateOne({'nbid': nb['nbid']}, {'$set': {'noteCount': note_counts.get(nb['nbid'], 0), 'topTags': top_tags(nb['nbid'])}})
+        for nb in notebooks.find({}, {'nbid': True})]
+    if requests:
+        notebooks.bulk_write(requests, ordered=False)
+
+# command for recounting the tags and notes of every notebook
+@app.cli.command('rebuild-tag-counts')
+def rebuild_tag_counts_command():
+    rebuild_tag_counts()
+    rebuild_notebook_summaries()
+    click.echo('{} tag counts'.format(tag_counts.count_documents({})))
+
+# command for numbering the notes a sync from 0 would leave out
+@app.cli.command('backfill-change-seqs')
+def backfill_change_seqs_command():
+    click.echo('{} notes numbered'.format(backfill_change_seqs()))
+
+# command for listing which queries are served by an index
+@app.cli.command('index-report')
+def index_report_command():
+    for entry in index_report():
+        status = 'index' if entry['covered'] else 'COLLSCAN'
+        click.echo('{:<40} {:<10} {:<9} {}'.format(entry['route'], entry['collection'], status, ', '.join(entry['indexes'])))
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# writes datetimes as HTTP dates, the same way Flask's encoder does, without
+# going through time.gmtime and strftime for each one
+def json_default(value):
+    if isinstance(value, datetime):
+        return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+            WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1], value.year, value.hour, value.minute, value.second)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+# encodes data as JSON bytes, with orjson's native encoder when FAST_JSON is set
+def dumps(data):
+    if app.config['FAST_JSON']:
+        return orjson.dumps(data, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data).encode('utf-8')
+
+def json_response(data):
+    return Response(dumps(data), mimetype='application/json')
+
+def wants_bson():
+    return request.accept_mimetypes.best == 'application/bson'
+
+def bson_response(data):
+    return Response(bson.encode(data), mimetype='application/bson')
 
 def no_content():
     abort(Response(response='204: No resource exists', content_type='application/json', status=204))
@@ -22,75 +450,470 @@ def no_content():
 def missing_or_invalid_key():
     abort(Response(response='400: Request body has missing or invalid parameters', content_type='application/json', status=400))
 
+def invalid_parameter():
+    abort(Response(response='400: Request has missing or invalid query parameters', content_type='application/json', status=400))
+
+def sync_token_expired():
+    abort(Response(response='410: Sync token has expired, sync again from 0', content_type='application/json', status=410))
+
+def request_too_large():
+    abort(Response(response='413: Request body is too large', content_type='application/json', status=413))
+
 def missing_notebook():
     abort(Response(response='400: Invalid notebook', content_type='application/json', status=400))
 
+# reads an integer query parameter, returning a 400 status if it is not a number;
+# args default to the request's, asgi.py passes its own
+def int_arg(name, args=None):
+    value = (request.args if args is None else args).get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        invalid_parameter()
+
+# reads the ?limit= and ?after= parameters of the list routes, limit is None
+# when the whole list is requested
+def page_args(args=None):
+    limit = int_arg('limit', args)
+    after = int_arg('after', args)
+    if limit is not None and not 0 < limit <= app.config['MAX_PAGE_SIZE']:
+        invalid_parameter()
+    return limit, after
+
+# runs a query in key order starting after the given key, and returns one page
+# of documents along with the key to pass as ?after= for the next page
+def find_page(collection, query, key, limit, after, projection=None):
+    cursor = page_cursor(collection, query, key, after, projection)
+    if limit is None:
+        return cursor, None
+    return page_result(list(cursor.limit(limit + 1)), key, limit)
+
+# the cursor over the entries after the given key in key order, for a PyMongo
+# or a Motor collection
+def page_cursor(collection, query, key, after, projection=None):
+    if after is not None:
+        query = dict(query, **{key: {'$gt': after}})
+    return collection.find(query, projection).sort(key, ASCENDING)
+
+# splits the limit + 1 documents read for a page into the page and the key of
+# its last entry, or None when there is no following page
+def page_result(documents, key, limit):
+    if len(documents) > limit:
+        return documents[:limit], documents[limit - 1][key]
+    return documents, None
+
+# reads a page of notes holding the given fields, as undecoded BSON documents
+# that are copied into the response as they are when the client accepts
+# application/bson, and as Note records otherwise
+def find_notes_page(query, limit, after, fields):
+    if wants_bson():
+        note_data, next_after = find_page(raw_notes, query, 'nid', limit, after, note_projection(fields))
+        return list(note_data), next_after
+    note_data, next_after = find_page(read_notes, query, 'nid', limit, after, note_projection(fields))
+    return [note_output(n, fields) for n in note_data], next_after
+
+# reads the ?fields= parameter into the note fields to return, nid is always
+# returned and a 400 status is returned for unknown fields
+def note_fields(args=None):
+    fields = (request.args if args is None else args).get('fields')
+    if fields is None:
+        return NOTE_FIELDS
+    fields = [field.strip() for field in fields.split(',')]
+    if not all(field in NOTE_FIELDS for field in fields):
+        invalid_parameter()
+    return tuple(field for field in NOTE_FIELDS if field == 'nid' or field in fields)
+
+# limits the documents read from the database to the requested fields
+def note_projection(fields):
+    projection = {'_id': False}
+    for field in fields:
+        projection[field] = True
+    return projection
+
+# checks the values of a new note have the right types
+def valid_new_note(title, body, tags, nbid):
+    return isinstance(title, str) and isinstance(body, str) and isinstance(tags, list) and isinstance(nbid, int)
+
+# a note read with note_projection(fields) holds exactly those fields and is
+# returned as it was decoded, anything else is copied field by field, leaving
+# out fields the note does not have
+def note_output(n, fields=NOTE_FIELDS):
+    if n.keys() == set(fields):
+        return n
+    return Note((field, n[field]) for field in fields if field in n)
+
+# reads ?stream= and the type the client accepts best into whether to stream
+# the notes and whether as NDJSON, returning a 400 status for unknown modes
+def stream_args(args, best_accept):
+    stream = args.get('stream')
+    if stream not in (None, '1', 'ndjson'):
+        invalid_parameter()
+    ndjson = stream == 'ndjson' or best_accept == 'application/x-ndjson'
+    return bool(stream) or ndjson, ndjson
+
+# the cursor over the notes a stream returns, for a PyMongo or a Motor collection
+def stream_cursor(collection, limit, after, fields):
+    query = {} if after is None else {'nid': {'$gt': after}}
+    return collection.find(query, note_projection(fields)).sort('nid', ASCENDING).limit(limit or 0)
+
+# encodes a chunk of streamed notes, written is the number of notes already sent
+def notes_chunk(chunk, ndjson, fields, written):
+    if ndjson:
+        return b''.join(dumps(note_output(n, fields)) + b'\n' for n in chunk)
+    return b''.join((b', ' if written + i else b'') + dumps(note_output(n, fields)) for i, n in enumerate(chunk))
+
+# yields the notes of a cursor as one JSON document per line, or as the same
+# {"result": [...]} document the list routes return, a chunk of notes at a time
+def stream_notes(note_entries, ndjson, fields):
+    if not ndjson:
+        yield b'{"result": ['
+    chunk = []
+    written = 0
+    for n in note_entries:
+        chunk.append(n)
+        if len(chunk) == app.config['STREAM_CHUNK_SIZE']:
+            yield notes_chunk(chunk, ndjson, fields, written)
+            written += len(chunk)
+            chunk = []
+    yield notes_chunk(chunk, ndjson, fields, written)
+    if not ndjson:
+        yield b']}'
+
+# sets the ETag and Last-Modified headers of a response, the query string is
+# part of the ETag since each set of parameters gives a different body
+def set_validators(response, etag, last_modified):
+    response.set_etag(query_etag(etag, request.query_string, wants_bson()))
+    if last_modified:
+        response.last_modified = last_modified
+    return response.make_conditional(request)
+
+# returns a 304 response when If-None-Match or If-Modified-Since show the
+# client already has this version, and None otherwise
+def not_modified(etag, last_modified):
+    response = set_validators(Response(status=200), etag, last_modified)
+    if response.status_code == 304:
+        return response
+
+def query_etag(etag, query_string, bson_body=False):
+    if query_string:
+        etag = '{}-{:x}'.format(etag, zlib.crc32(query_string))
+    if bson_body:
+        etag += '-bson'
+    return etag
+
+def note_etag(nid, last_modified):
+    return 'n{}-{:%Y%m%d%H%M%S%f}'.format(nid, last_modified)
+
+# notebooks carry a version that every change to them or their notes increments
+def notebook_etag(nb):
+    return 'nb{}-{}'.format(nb['nbid'], nb.get('version', 0))
+
+# adds change to the count of each distinct tag of a note in changes, which
+# maps (nbid, tag) to the change in its count
+def tag_changes(changes, nbid, tags, change):
+    for tag in set(tag for tag in tags if isinstance(tag, str)):
+        changes[(nbid, tag)] = changes.get((nbid, tag), 0) + change
+    return changes
+
+# the writes applying tag count changes, along with the matching changes to the
+# counts across all notebooks, which are kept under an nbid of None
+def tag_count_requests(changes):
+    totals = {}
+    for (nbid, tag), change in changes.items():
+        if nbid is not None:
+            totals[(None, tag)] = totals.get((None, tag), 0) + change
+    return [UpdateOne({'nbid': nbid, 'tag': tag}, {'$inc': {'count': change}}, upsert=True)
+        for (nbid, tag), change in list(changes.items()) + list(totals.items()) if change]
+
+# two requests upserting the same new tag at once, one of them fails with a
+# duplicate key error and is retried as a plain update; anything else is raised
+def tag_count_retries(requests, error):
+    retries = [requests[write_error['index']] for write_error in error.details['writeErrors'] if write_error['code'] == 11000]
+    if len(retries) < len(error.details['writeErrors']):
+        raise error
+    return retries
+
+# the query for the counts that changes may have brought down to zero, or None
+def empty_tag_counts(changes):
+    if any(change < 0 for change in changes.values()):
+        nbids = list(set(nbid for nbid, tag in changes) | {None})
+        return {'nbid': {'$in': nbids}, 'count': {'$lte': 0}}
+
+# the changes to the counts across all notebooks when the tag counts of a
+# notebook, given as entries, are removed along with it
+def removed_tag_changes(entries):
+    return dict(((None, entry['tag']), -entry['count']) for entry in entries)
+
+# applies tag count changes in one batch, removing tags no note carries any more
+def update_tag_counts(changes):
+    requests = tag_count_requests(changes)
+    if not requests:
+        return
+    try:
+        tag_counts.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        tag_counts.bulk_write(tag_count_retries(requests, e), ordered=False)
+    cleanup = empty_tag_counts(changes)
+    if cleanup:
+        tag_counts.delete_many(cleanup)
+
+# records the deletion of the given notes of a notebook for GET /note/changes
+def add_tombstones(nids, nbid, time):
+    seq = change_seqs.reserve(len(nids))
+    deleted_notes.insert_many(tombstones(nids, nbid, seq, time))
+
+# the records of deleted notes, numbered from seq
+def tombstones(nids, nbid, seq, time):
+    return [{'nid': nid, 'nbid': nbid, 'seq': seq + i, 'deleted': time} for i, nid in enumerate(nids)]
+
+# removes the records of notes deleted more than SYNC_RETENTION_DAYS ago, in
+# change order, and first moves the purgedSeq counter over them so
+# GET /note/changes refuses tokens that could miss one; returns how many were removed
+def purge_tombstones():
+    cutoff = datetime.utcnow() - timedelta(days=app.config['SYNC_RETENTION_DAYS'])
+    first_kept = deleted_notes.find_one({'deleted': {'$gte': cutoff}}, sort=[('seq', ASCENDING)], projection={'seq': True})
+    query = {} if first_kept is None else {'seq': {'$lt': first_kept['seq']}}
+    last = deleted_notes.find_one(dict(query, deleted={'$lt': cutoff}), sort=[('seq', DESCENDING)], projection={'seq': True})
+    if last is None:
+        return 0
+    try:
+        counters.update_one({'_id': 'purgedSeq'}, {'$max': {'seq': last['seq']}}, upsert=True)
+    except DuplicateKeyError:
+        counters.update_one({'_id': 'purgedSeq'}, {'$max': {'seq': last['seq']}})
+    return deleted_notes.delete_many({'seq': {'$lte': last['seq']}}).deleted_count
+
+# numbers the notes written before GET /note/changes existed, which have no
+# seq and would otherwise be left out of a sync from 0; notes are numbered in
+# batches, and a note edited meanwhile keeps the seq its edit gave it
+def backfill_change_seqs(batch_size=1000):
+    assigned = 0
+    while True:
+        nids = [n['nid'] for n in notes.find({'seq': {'$exists': False}}, {'_id': False, 'nid': True}).sort('nid', ASCENDING).limit(batch_size)]
+        if not nids:
+            return assigned
+        seq = change_seqs.reserve(len(nids))
+        result = notes.bulk_write([UpdateOne({'nid': nid, 'seq': {'$exists': False}}, {'$set': {'seq': seq + i}}) for i, nid in enumerate(nids)], ordered=False)
+        assigned += result.modified_count
+
+# the most used tags of a notebook, read with the (nbid, count) index
+def top_tags(nbid):
+    return tag_count_output(top_tags_cursor(tag_counts, nbid))
+
+# the cursor over the most used tags of a notebook, for a PyMongo or a Motor collection
+def top_tags_cursor(collection, nbid):
+    return collection.find({'nbid': nbid}).sort([('count', DESCENDING), ('tag', ASCENDING)]).limit(app.config['TOP_TAGS'])
+
+# records a change to the notes of the given notebooks, note_counts maps each
+# notebook id to the change in its number of notes, and the top tags of the
+# notebooks in the tag changes are read again once they have been applied
+def touch_notebooks(note_counts, time, changes=()):
+    retagged = set(nbid for nbid, tag in changes)
+    requests = [touch_request(nbid, change, time, top_tags(nbid) if nbid in retagged else None)
+        for nbid, change in note_counts.items()]
+    if requests:
+        notebooks.bulk_write(requests, ordered=False)
+
+# the write recording a change of change notes to a notebook, and its new top
+# tags when they are given
+def touch_request(nbid, change, time, top=None):
+    update = {'$inc': {'version': 1, 'noteCount': change}, '$set': {'lastModified': time}}
+    if top is not None:
+        update['$set']['topTags'] = top
+    return UpdateOne({'nbid': nbid}, update)
+
+# the summary of a notebook listed by GET /notebook
+def notebook_summary(nb):
+    return {
+        'nbid': nb['nbid'],
+        'name': nb['name'],
+        'noteCount': nb.get('noteCount', 0),
+        'lastModified': nb.get('lastModified'),
+        'topTags': nb.get('topTags', []),
+    }
+
+# returns the cached response for key, only plain requests without query
+# parameters are cached, the ETag and Last-Modified headers are kept on the
+# first two lines of the entry
+def cached_response(key):
+    if request.args or wants_bson():
+        return None
+    value = cache.get(key)
+    if value is not None:
+        etag, last_modified, body = value.split(b'\n', 2)
+        response = Response(body, mimetype='application/json')
+        response.headers['ETag'] = etag.decode()
+        if last_modified:
+            response.headers['Last-Modified'] = last_modified.decode()
+        return response.make_conditional(request)
+
+# stores a response for cached_response, unchanged checks on the primary that
+# the document the body was read from has not been written since; a write
+# between the read and the store may already have removed the entry, so the
+# check runs after storing it and removes a body that is already stale
+def cache_response(key, response, unchanged):
+    if not request.args and not wants_bson() and response.status_code == 200:
+        headers = [response.headers.get(name, '').encode() for name in ('ETag', 'Last-Modified')]
+        cache.set(key, b'\n'.join(headers + [response.get_data()]))
+        if not unchanged():
+            cache.delete(key)
+    return response
+
+def list_response(output, limit, next_after):
+    response = list_document(output, limit, next_after)
+    if wants_bson():
+        return bson_response(response)
+    return json_response(response)
+
+def list_document(output, limit, next_after):
+    response = {'result': output}
+    # the next cursor is only included for paginated requests
+    if limit is not None:
+        response['next'] = next_after
+    return response
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS']:
+        g.started = perf_counter()
+        command_stats.begin()
+
+# records the request once its response is final, since this hook is
+# registered first it runs after every other after_request hook, so sizes are
+# of the compressed body
+@app.after_request
+def record_request_metrics(response):
+    if app.config['METRICS'] and 'started' in g:
+        command_count, command_seconds, commands = command_stats.end()
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        size = None if response.is_streamed else response.content_length
+        request_metrics.observe(request.method, route, response.status_code, perf_counter() - g.started, size, command_count, commands)
+    return response
+
+# compresses successful responses with the encoding the client prefers, streamed
+# responses chunk by chunk and others only when they reach COMPRESS_MIN_SIZE;
+# event streams are left alone, a compressor would hold events back
+@app.after_request
+def compress_response(response):
+    if not app.config['COMPRESSION'] or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype == 'text/event-stream':
+        return response
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+    level = app.config['COMPRESS_LEVELS'][encoding]
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        if response.content_length is None or response.content_length < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress(response.get_data(), encoding, level))
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    # the compressed body is not byte for byte the one the ETag was made for,
+    # a weak ETag still lets If-None-Match match it
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
 # route for retrieving all notes
 @app.route('/notebook', methods=['GET'])
 def get_all_notebooks():
     output = []
-    nb_entries = notebooks.find()
+    limit, after = page_args()
+    nb_entries, next_after = find_page(read_notebooks, {}, 'nbid', limit, after)
     # appends notebook objects to the output if any are found
     if nb_entries:
         for nb in nb_entries:
-            output.append({'nbid': nb['nbid'], 'name' : nb['name']})
+            output.append(notebook_summary(nb))
    
-    return jsonify({'result' : output})
+    return list_response(output, limit, next_after)
 
 # route for retrieving one notebook by id number
 @app.route('/notebook/<int:nbid>', methods=['GET'])
 def get_one_notebook(nbid):
     output = []
-    nb = notebooks.find_one({'nbid': nbid})
+    cached = cached_response('notebook:{}'.format(nbid))
+    if cached:
+        return cached
+    limit, after = page_args()
+    fields = note_fields()
+    nb = read_notebooks.find_one({'nbid': nbid})
     # returns a notebook object if one exists
     if nb:
-        note_data = notes.find({'nbid': {'$eq': nbid}})
+        # answers with a 304 status before reading any notes if the client is up to date
+        unchanged = not_modified(notebook_etag(nb), nb.get('lastModified'))
+        if unchanged:
+            return unchanged
+        note_data, next_after = find_notes_page({'nbid': nbid}, limit, after, fields)
         output.append({
             'nbid': nb['nbid'], 
             'name': nb['name'],
-            'notes': []})
-        for n in note_data:
-            output[0]['notes'].append({
-                'nid': n['nid'], 
-                'title' : n['title'],
-                'nbid': n['nbid'],
-                'body': n['body'],
-                'tags': n['tags'],
-                'created': n['created'],
-                'lastModified': n['lastModified']            
-            })
-        return jsonify({'result' : output})
+            'notes': note_data})
+        response = set_validators(list_response(output, limit, next_after), notebook_etag(nb), nb.get('lastModified'))
+        return cache_response('notebook:{}'.format(nbid), response,
+            lambda: notebooks.find_one({'nbid': nbid, 'version': nb.get('version')}, {'_id': True}) is not None)
     # returns a 204 status code if not
     else:
         no_content()
 
+# route for retrieving one notebook with only the notes carrying the given tag,
+# further tags can be passed as ?tag=<tag> and matched with ?match=any or ?match=all
 @app.route('/notebook/<int:nbid>/<string:tag>', methods=['GET'])
 def get_one_notebook_by_tag(nbid, tag):
     output = []
-    nb = notebooks.find_one({'nbid': nbid})
+    tags = [tag] + request.args.getlist('tag')
+    match = request.args.get('match', 'any')
+    # returns a 400 status if the match mode is not recognised
+    if match not in ('any', 'all'):
+        invalid_parameter()
+    limit, after = page_args()
+    fields = note_fields()
+    nb = read_notebooks.find_one({'nbid': nbid})
     # returns a notebook object if one exists
     if nb:
-        note_data = notes.find({'nbid': {'$eq': nbid}})
+        # filters the notes in the database using the (nbid, tags) index
+        if len(tags) == 1:
+            tag_query = tag
+        elif match == 'all':
+            tag_query = {'$all': tags}
+        else:
+            tag_query = {'$in': tags}
+        note_data, next_after = find_page(read_notes, {'nbid': nbid, 'tags': tag_query}, 'nid', limit, after, note_projection(fields))
         output.append({
             'nbid': nb['nbid'], 
             'name': nb['name'],
             'notes': []})
         for n in note_data:
-            if tag in n['tags']:
-                output[0]['notes'].append({
-                    'nid': n['nid'], 
-                    'title' : n['title'],
-                    'nbid': n['nbid'],
-                    'body': n['body'],
-                    'tags': n['tags'],
-                    'created': n['created'],
-                    'lastModified': n['lastModified']            
-                })
-        return jsonify({'result' : output})
+            output[0]['notes'].append(note_output(n, fields))
+        return list_response(output, limit, next_after)
     # returns a 204 status code if not
     else:
         no_content()
 
+def tag_count_output(entries):
+    return [{'tag': entry['tag'], 'count': entry['count']} for entry in entries]
+
+# the cursor over the tag counts of a notebook, or across all notebooks, which
+# are kept under an nbid of None, for a PyMongo or a Motor collection
+def tag_counts_cursor(collection, nbid):
+    return collection.find({'nbid': nbid}).sort([('count', DESCENDING), ('tag', ASCENDING)])
+
+# route for counting the notes carrying each tag, most used first, across all
+# notebooks or in the notebook given as ?nbid=; it is not served under
+# /notebook/<nbid> where it would hide the notes tagged 'tags'
+@app.route('/tags', methods=['GET'])
+def get_tags():
+    nbid = int_arg('nbid')
+    # returns a 204 status code if the notebook does not exist
+    if nbid is not None and not read_notebooks.find_one({'nbid': nbid}, {'_id': True}):
+        no_content()
+    return json_response({'result' : tag_count_output(tag_counts_cursor(read_tag_counts, nbid))})
+
 # route for posting a new notebook
 @app.route('/notebook', methods=['POST'])
 def post_notebook():
@@ -99,99 +922,337 @@ def post_notebook():
     # returns a 400 status if no name is present in the request body
     if not name:
         missing_or_invalid_key()
-    max_id_nb = notebooks.find_one(sort=[('nbid', -1)])
-    # increments the notebook id number and sets it to 1 if the collection is empty
-    if max_id_nb:
-        nbid = max_id_nb['nbid'] + 1
-    else:
-        nbid = 1
+    nbid = notebook_ids.reserve()
     # inserts a new notebook and returns the newly created notebook data
-    notebooks.insert_one({'name': name, 'nbid': nbid})
-    new_nb = notebooks.find_one({'nbid': nbid})
-    output.append({'nbid': nbid, 'name' : new_nb['name']})
-    return jsonify({'result' : output})
+    notebooks.insert_one({'name': name, 'nbid': nbid, 'version': 1, 'lastModified': datetime.utcnow(), 'noteCount': 0, 'topTags': []})
+    output.append({'nbid': nbid, 'name' : name})
+    return json_response({'result' : output})
 
 # route for editing an existing notebook
 @app.route('/notebook/<int:nbid>', methods=['PUT'])
 def edit_notebook(nbid):
     output = []
     new_name = request.json.get('name')
-    nb = notebooks.find_one({'nbid': nbid})
     # checks the name in the body is a string, returns a 400 status otherwise
     if isinstance(new_name, str):
+        updated_nb = notebooks.find_one_and_update(
+            {'nbid': nbid},
+            {'$set': {'name': new_name, 'lastModified': datetime.utcnow()}, '$inc': {'version': 1}},
+            projection={'_id': False, 'nbid': True, 'name': True},
+            return_document=ReturnDocument.AFTER)
         # checks that the notebook exists and returns a 204 status otherwise
-        if nb:
-            notebooks.update_one({'nbid': nbid}, {'$set': {'name': new_name}})
-            updated_nb = notebooks.find_one({'nbid': nbid})
+        if updated_nb:
+            cache.delete('notebook:{}'.format(nbid))
             output.append({'nbid': updated_nb['nbid'], 'name' : updated_nb['name']})
-            return jsonify({'result' : output})
+            return json_response({'result' : output})
         else:
             no_content()
     else:
         missing_or_invalid_key()
     
-# route for deleting a notebook
+# deletes the notes of a notebook a batch at a time and yields the ids of each
+# batch, so no single delete holds the database or the worker for long
+def delete_notebook_notes(nbid):
+    while True:
+        nids = [n['nid'] for n in delete_batch_cursor(notes, nbid)]
+        if not nids:
+            return
+        notes.delete_many({'nid': {'$in': nids}})
+        add_tombstones(nids, nbid, datetime.utcnow())
+        cache.delete(*['note:{}'.format(nid) for nid in nids])
+        yield nids
+
+# the cursor over the next batch of notes to delete from a notebook, for a
+# PyMongo or a Motor collection
+def delete_batch_cursor(collection, nbid):
+    return collection.find({'nbid': nbid}, {'_id': False, 'nid': True}).sort('nid', ASCENDING).limit(app.config['DELETE_BATCH_SIZE'])
+
+# the job document of a background delete of a notebook's notes
+def delete_job(jobid, nbid, time):
+    return {
+        'jobid': jobid,
+        'type': 'delete_notebook',
+        'nbid': nbid,
+        'status': 'running',
+        'deletedNotes': 0,
+        'created': time,
+        'lastModified': time
+    }
+
+# the updates recording a job's progress, its end and its failure
+def job_progress(jobid, count):
+    return {'jobid': jobid}, {'$inc': {'deletedNotes': count}, '$set': {'lastModified': datetime.utcnow()}}
+
+def job_done(jobid):
+    return {'jobid': jobid}, {'$set': {'status': 'done', 'lastModified': datetime.utcnow()}}
+
+def job_failed(jobid, error):
+    return {'jobid': jobid}, {'$set': {'status': 'failed', 'error': str(error), 'lastModified': datetime.utcnow()}}
+
+delete_job_slots = threading.BoundedSemaphore(app.config['MAX_DELETE_JOBS'])
+
+# deletes the notes of a notebook in a background thread, recording progress
+# on the job, and frees the slot the job was started in
+def run_delete_job(jobid, nbid):
+    try:
+        for nids in delete_notebook_notes(nbid):
+            jobs.update_one(*job_progress(jobid, len(nids)))
+        jobs.update_one(*job_done(jobid))
+    except Exception as e:
+        jobs.update_one(*job_failed(jobid, e))
+    finally:
+        delete_job_slots.release()
+
+# starts a delete job if fewer than MAX_DELETE_JOBS are running in this
+# process, otherwise leaves it for resume_stale_jobs to start once it is stale
+def start_delete_job(jobid, nbid):
+    if delete_job_slots.acquire(blocking=False):
+        threading.Thread(target=run_delete_job, args=(jobid, nbid), daemon=True).start()
+
+# resumes the background jobs whose worker exited part way through, claiming
+# each one by moving its lastModified forward so only one worker picks it up
+def resume_stale_jobs():
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=app.config['JOB_STALE_SECONDS'])
+    # claims jobs only while this process has a free slot to run them in
+    while delete_job_slots.acquire(blocking=False):
+        job = jobs.find_one_and_update(
+            {'type': 'delete_notebook', 'status': 'running', 'lastModified': {'$lt': cutoff}},
+            {'$set': {'lastModified': now}, '$inc': {'resumed': 1}},
+            projection={'_id': False, 'jobid': True, 'nbid': True})
+        if not job:
+            delete_job_slots.release()
+            return
+        threading.Thread(target=run_delete_job, args=(job['jobid'], job['nbid']), daemon=True).start()
+
+# resumes stale jobs and purges expired deleted note records when the worker
+# starts and every JOB_STALE_SECONDS after
+def run_maintenance():
+    while True:
+        for task in (resume_stale_jobs, purge_tombstones):
+            try:
+                task()
+            except PyMongoError as e:
+                app.logger.warning('%s failed: %s', task.__name__, e)
+        sleep(app.config['JOB_STALE_SECONDS'])
+
+@app.before_first_request
+def start_maintenance():
+    threading.Thread(target=run_maintenance, daemon=True).start()
+
+# yields the deleted notebook as a JSON document while its notes are deleted,
+# writing the ids of each batch of notes as soon as it has been removed
+def stream_deleted_notebook(nb):
+    yield deleted_notebook_head(nb)
+    separator = b''
+    batches = delete_notebook_notes(nb['nbid'])
+    try:
+        for nids in batches:
+            yield separator + b', '.join(b'%d' % nid for nid in nids)
+            separator = b', '
+        yield b']}]}'
+    finally:
+        # finishes the cascade even if the client disconnects part way through
+        for nids in batches:
+            pass
+
+# the start of the document streamed by a delete with ?notes=ids, up to the ids
+def deleted_notebook_head(nb):
+    return b'{"result": [{"nbid": %s, "name": %s, "deletedNotes": [' % (dumps(nb['nbid']), dumps(nb['name']))
+
+# reads ?notes= and ?background= of a notebook delete, returning a 400 status
+# for an unknown response mode
+def delete_args(args=None):
+    args = request.args if args is None else args
+    mode = args.get('notes', 'count')
+    if mode not in ('count', 'ids'):
+        invalid_parameter()
+    return mode, args.get('background') == '1'
+
+# route for deleting a notebook and all of its notes, returns the number of notes
+# deleted, ?notes=ids streams their ids instead and ?background=1 deletes them in
+# a job that can be followed at /job/<jobid>
 @app.route('/notebook/<int:nbid>', methods=['DELETE'])
 def delete_notebook(nbid):
     output = []
-    nb = notebooks.find_one({'nbid': nbid})
-    # checks that the notebook exists, returns a 204 status if not
+    # returns a 400 status if the response mode is not recognised
+    mode, background = delete_args()
+    # deletes the notebook first so no new notes can be added to it during the cascade
+    nb = notebooks.find_one_and_delete({'nbid': nbid}, projection={'_id': False, 'nbid': True, 'name': True})
+    # checks that the notebook existed, returns a 204 status if not
     if nb:
-        # deletes the notebook and all corresponding notes, and returns the deleted notebook
-        notebooks.delete_one({'nbid': nbid})
-        note_data = notes.delete_many({'nbid': {'$eq': nbid}})
-        output.append({'nbid': nb['nbid'], 'name' : nb['name'], 'notes': []})
-        for note in note_data:
-            output[0]['notes'].append({
-                'nid': note['nid'], 
-                'title' : note['title'],
-                'nbid': note['nbid'],
-                'body': note['body'],
-                'tags': note['tags'],
-                'created': note['created'],
-                'lastModified': note['lastModified']
-            })
-        return jsonify({'result' : output})
+        cache.delete('notebook:{}'.format(nbid))
+        update_tag_counts(removed_tag_changes(tag_counts.find({'nbid': nbid})))
+        tag_counts.delete_many({'nbid': nbid})
+        if background:
+            time = datetime.utcnow()
+            jobid = job_ids.reserve()
+            jobs.insert_one(delete_job(jobid, nbid, time))
+            start_delete_job(jobid, nbid)
+            output.append({'nbid': nb['nbid'], 'name' : nb['name'], 'job': jobid})
+            return json_response({'result' : output}), 202
+        if mode == 'ids':
+            return Response(stream_with_context(stream_deleted_notebook(nb)), mimetype='application/json')
+        deleted = sum(len(nids) for nids in delete_notebook_notes(nbid))
+        output.append({'nbid': nb['nbid'], 'name' : nb['name'], 'deletedNotes': deleted})
+        return json_response({'result' : output})
     else:
         no_content()
 
-# route for getting all existing notes
+# route for checking on a background job
+@app.route('/job/<int:jobid>', methods=['GET'])
+def get_job(jobid):
+    output = []
+    job = jobs.find_one({'jobid': jobid}, {'_id': False})
+    # returns the job if it exists, and a 204 status if not
+    if job:
+        output.append(job)
+        return json_response({'result' : output})
+    else:
+        no_content()
+
+# route for getting all existing notes, ?stream=1 or ?stream=ndjson (or an
+# Accept: application/x-ndjson header) streams them straight from the cursor
 @app.route('/note', methods=['GET'])
 def get_all_notes():
-    output = []
-    note_entries = notes.find()
+    limit, after = page_args()
+    fields = note_fields()
+    # returns a 400 status if the stream mode is not recognised
+    stream, ndjson = stream_args(request.args, request.accept_mimetypes.best)
+    if stream:
+        note_entries = stream_cursor(read_notes, limit, after, fields)
+        mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+        return Response(stream_with_context(stream_notes(note_entries, ndjson, fields)), mimetype=mimetype)
     # returns a list of all notes if they exist and an empty list if not
-    if note_entries:
-        for n in note_entries:
-            output.append({
-                'nid': n['nid'], 
-                'title' : n['title'],
-                'nbid': n['nbid'],
-                'body': n['body'],
-                'tags': n['tags'],
-                'created': n['created'],
-                'lastModified': n['lastModified']
-            })
-
-    return jsonify({'result' : output})
+    output, next_after = find_notes_page({}, limit, after, fields)
+    return list_response(output, limit, next_after)
+
+# route for the notes created, edited or deleted since a sync token, ?since=
+# takes the next token of the previous response (0 or none for everything);
+# it always reads from the primary, a lagging secondary could let the token
+# move past changes it has not received yet
+@app.route('/note/changes', methods=['GET'])
+def get_note_changes():
+    since, limit, fields = changes_args()
+    # returns a 410 status if deletions after the token may have been purged
+    if since:
+        check_sync_token(since, counters.find_one({'_id': 'purgedSeq'}))
+    changed = list(changed_cursor(notes, since, limit, fields))
+    deleted = list(deleted_cursor(deleted_notes, since, limit))
+    return json_response(changes_document(changed, deleted, since, limit, fields))
+
+# reads ?since=, ?limit= and ?fields= of GET /note/changes, returning a 400
+# status if the page size is out of range
+def changes_args(args=None):
+    since = int_arg('since', args) or 0
+    limit = int_arg('limit', args)
+    if limit is None:
+        limit = app.config['MAX_PAGE_SIZE']
+    fields = note_fields(args)
+    if not 0 < limit <= app.config['MAX_PAGE_SIZE']:
+        invalid_parameter()
+    return since, limit, fields
+
+# returns a 410 status if since is older than the deletions already purged,
+# purged being the purgedSeq counter document
+def check_sync_token(since, purged):
+    if purged and since < purged['seq']:
+        sync_token_expired()
+
+# the cursors over the notes written and deleted after since, in change
+# order, for PyMongo or Motor collections
+def changed_cursor(collection, since, limit, fields):
+    return collection.find({'seq': {'$gt': since}}, note_projection(fields + ('seq', 'lastModified'))).sort('seq', ASCENDING).limit(limit + 1)
+
+def deleted_cursor(collection, since, limit):
+    return collection.find({'seq': {'$gt': since}}, {'_id': False}).sort('seq', ASCENDING).limit(limit + 1)
+
+# the GET /note/changes document from the limit + 1 changed and deleted notes
+# read after since
+def changes_document(changed, deleted, since, limit, fields):
+    entries = sorted(changed + deleted, key=lambda entry: entry['seq'])
+    page = entries[:limit]
+    # moves the token over the changes in order, stopping at the first one too
+    # recent to be sure no earlier change is still being written
+    cutoff = datetime.utcnow() - timedelta(milliseconds=app.config['SYNC_SETTLE_MS'])
+    token = since
+    for entry in page:
+        if entry.get('deleted', entry.get('lastModified')) >= cutoff:
+            break
+        token = entry['seq']
+    return {
+        'result': [note_output(entry, fields) for entry in page if 'deleted' not in entry],
+        'deleted': [entry['nid'] for entry in page if 'deleted' in entry],
+        'next': token,
+        'more': len(entries) > limit and token == page[-1]['seq'],
+    }
+
+# route for searching the titles, tags and bodies of notes, best matches first,
+# ?nbid= limits the search to one notebook and ?limit= and ?offset= page through
+# the results
+@app.route('/note/search', methods=['GET'])
+def search_notes():
+    # returns a 400 status if there is nothing to search for or the page is out of range
+    terms, nbid, limit, offset, fields = search_args()
+    note_entries = list(search_cursor(read_notes, terms, nbid, limit, offset, fields))
+    return json_response(search_document(note_entries, limit, offset, fields))
+
+# reads ?q=, ?nbid=, ?limit=, ?offset= and ?fields= of a search, returning a
+# 400 status if there is nothing to search for or the page is out of range
+def search_args(args=None):
+    args = request.args if args is None else args
+    terms = args.get('q', '').strip()
+    nbid = int_arg('nbid', args)
+    limit = int_arg('limit', args)
+    if limit is None:
+        limit = app.config['SEARCH_PAGE_SIZE']
+    offset = int_arg('offset', args) or 0
+    fields = note_fields(args)
+    if not terms or not 0 < limit <= app.config['MAX_PAGE_SIZE'] or offset < 0:
+        invalid_parameter()
+    return terms, nbid, limit, offset, fields
+
+# the cursor over the limit + 1 best matches from offset, for a PyMongo or a
+# Motor collection
+def search_cursor(collection, terms, nbid, limit, offset, fields):
+    query = {'$text': {'$search': terms}}
+    if nbid is not None:
+        query['nbid'] = nbid
+    projection = note_projection(fields)
+    projection['score'] = {'$meta': 'textScore'}
+    return collection.find(query, projection).sort([('score', {'$meta': 'textScore'})]).skip(offset).limit(limit + 1)
+
+# the search response from the limit + 1 matches read
+def search_document(note_entries, limit, offset, fields):
+    output = []
+    for n in note_entries[:limit]:
+        result = note_output(n, fields)
+        result['score'] = n['score']
+        output.append(result)
+    next_offset = offset + limit if len(note_entries) > limit else None
+    return {'result' : output, 'next': next_offset}
 
 # route for getting a specific note
 @app.route('/note/<int:nid>', methods=['GET'])
 def get_one_note(nid):
     output = []
-    note = notes.find_one({'nid': nid})
+    cached = cached_response('note:{}'.format(nid))
+    if cached:
+        return cached
+    fields = note_fields()
+    # answers with a 304 status from the lastModified field alone if the client is up to date
+    if request.if_none_match or request.if_modified_since:
+        note = read_notes.find_one({'nid': nid}, {'_id': False, 'lastModified': True})
+        unchanged = note and not_modified(note_etag(nid, note['lastModified']), note['lastModified'])
+        if unchanged:
+            return unchanged
+    note = read_notes.find_one({'nid': nid}, note_projection(fields + ('lastModified',)))
     # returns a copy of the selected note if it exists, and a 204 status if not
     if note:
-        output.append({
-            'nid': note['nid'], 
-            'title' : note['title'],
-            'nbid': note['nbid'],
-            'body': note['body'],
-            'tags': note['tags'],
-            'created': note['created'],
-            'lastModified': note['lastModified']
-        })
-        return jsonify({'result' : output})
+        output.append(note_output(note, fields))
+        response = set_validators(json_response({'result' : output}), note_etag(nid, note['lastModified']), note['lastModified'])
+        return cache_response('note:{}'.format(nid), response,
+            lambda: notes.find_one({'nid': nid, 'lastModified': note['lastModified']}, {'_id': True}) is not None)
     else:
         no_content()
 
@@ -204,7 +1265,7 @@ def post_note():
     tags = request.json.get('tags', [])
     nbid = request.json.get('nbid')
     # returns a 400 status if any of the values passed in the body are the wrong type
-    if not isinstance(title, str) or not isinstance(body, str) or not isinstance(tags, list) or not isinstance(nbid, int):
+    if not valid_new_note(title, body, tags, nbid):
         missing_or_invalid_key()
 
     # returns a 400 if the notebook id passed does not exist
@@ -212,76 +1273,193 @@ def post_note():
         missing_notebook()
 
     time = datetime.utcnow()
-    max_id_note = notes.find_one(sort=[('nid', -1)])
-    # increments the note id number and sets it to 1 if the collection is empty
-    if max_id_note:
-        nid = max_id_note['nid'] + 1
-    else:
-        nid = 1
-    # inserts and retrieves the new note
-    notes.insert_one({
-        'title': title, 
-        'nid': nid,
-        'nbid': nbid,
-        'body': body,
-        'tags': tags,
-        'created': time,
-        'lastModified': time
-    })
-    new_note = notes.find_one({'nid': nid})
-    # appends the data from the newly created note
-    output.append({
-        'nid': nid, 
-        'title' : new_note['title'],
-        'nbid': new_note['nbid'],
-        'body': new_note['body'],
-        'tags': new_note['tags'],
-        'created': new_note['created'],
-        'lastModified': new_note['lastModified']
-    })
-    return jsonify({'result' : output})
+    new_note = Note.new(note_ids.reserve(), title, nbid, body, tags, time)
+    new_note['seq'] = change_seqs.reserve()
+    # inserts the new note and returns it as it was written
+    notes.insert_one(new_note)
+    changes = tag_changes({}, nbid, tags, 1)
+    update_tag_counts(changes)
+    touch_notebooks({nbid: 1}, time, changes)
+    cache.delete('notebook:{}'.format(nbid))
+    output.append(note_output(new_note))
+    return json_response({'result' : output})
+
+# reads the notes of a bulk request from a JSON array, or from one JSON note
+# per line when the body is sent as application/x-ndjson; the body is read no
+# further than MAX_CONTENT_LENGTH bytes or, for NDJSON, BULK_MAX_NOTES notes
+def bulk_note_items():
+    max_size = app.config['MAX_CONTENT_LENGTH']
+    # returns a 413 status before reading a body declared larger than allowed
+    if request.content_length is not None and request.content_length > max_size:
+        request_too_large()
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        size = 0
+        while True:
+            line = request.stream.readline(max_size + 1 - size)
+            if not line:
+                return items
+            size += len(line)
+            if size > max_size:
+                request_too_large()
+            add_ndjson_item(items, line)
+    if not request.is_json:
+        missing_or_invalid_key()
+    body = request.stream.read(max_size + 1)
+    if len(body) > max_size:
+        request_too_large()
+    return json_array_items(body)
+
+# adds the note on one line of an NDJSON body to items, returning a 400 status
+# as soon as one note more than allowed is sent
+def add_ndjson_item(items, line):
+    if line.strip():
+        if len(items) == app.config['BULK_MAX_NOTES']:
+            missing_or_invalid_key()
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+
+# the notes of a JSON array body, returning a 400 status for anything else
+def json_array_items(body):
+    try:
+        items = json.loads(body)
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        missing_or_invalid_key()
+    return items
+
+# checks the notes of a bulk request, returning the output entry of each and
+# the (index, note) pairs of the valid ones; returns a 400 status if more notes
+# are sent than a single request may create
+def bulk_new_notes(items):
+    if len(items) > app.config['BULK_MAX_NOTES']:
+        missing_or_invalid_key()
+    output = [{'index': index} for index in range(len(items))]
+    new_notes = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            item = {}
+        title = item.get('title')
+        body = item.get('body', '')
+        tags = item.get('tags', [])
+        nbid = item.get('nbid')
+        if valid_new_note(title, body, tags, nbid):
+            new_notes.append((index, Note.new(None, title, nbid, body, tags, None)))
+        else:
+            output[index].update({'status': 400, 'error': 'Missing or invalid parameters'})
+    return output, new_notes
+
+# the notes whose notebook is in existing, marking the others as failed
+def bulk_documents(output, new_notes, existing):
+    documents = []
+    for index, note in new_notes:
+        if note['nbid'] in existing:
+            documents.append((index, note))
+        else:
+            output[index].update({'status': 400, 'error': 'Invalid notebook'})
+    return documents
+
+# gives the notes to insert consecutive ids and change numbers from nid and seq
+def number_bulk_notes(output, documents, nid, seq, time):
+    for index, note in documents:
+        note.update(nid=nid, created=time, lastModified=time, seq=seq)
+        output[index].update({'status': 201, 'nid': nid})
+        nid += 1
+        seq += 1
+
+# marks the notes an unordered insert failed to write, returning their indexes
+def bulk_failures(output, documents, error):
+    failed = set()
+    for write_error in error.details['writeErrors']:
+        index = documents[write_error['index']][0]
+        failed.add(index)
+        output[index] = {'index': index, 'status': 500, 'error': write_error['errmsg']}
+    return failed
+
+# the tag count changes and notebook note counts of the notes written
+def bulk_changes(documents, failed):
+    changes = {}
+    note_counts = dict((note['nbid'], 0) for index, note in documents)
+    for index, note in documents:
+        if index not in failed:
+            tag_changes(changes, note['nbid'], note['tags'], 1)
+            note_counts[note['nbid']] += 1
+    return changes, note_counts
+
+# route for posting many notes at once, returns the status and id of each note
+# in the order they were sent
+@app.route('/note/bulk', methods=['POST'])
+def post_notes_bulk():
+    # returns a 400 status if more notes are sent than a single request may create
+    output, new_notes = bulk_new_notes(bulk_note_items())
+
+    # checks every distinct notebook id exists with a single query
+    nbids = list(set(note['nbid'] for index, note in new_notes))
+    existing = set(nb['nbid'] for nb in notebooks.find({'nbid': {'$in': nbids}}, {'nbid': True}))
+    documents = bulk_documents(output, new_notes, existing)
+
+    if documents:
+        time = datetime.utcnow()
+        number_bulk_notes(output, documents, note_ids.reserve(len(documents)), change_seqs.reserve(len(documents)), time)
+        # inserts every valid note in one unordered batch, notes that fail do
+        # not stop the rest from being written
+        failed = set()
+        try:
+            notes.insert_many([note for index, note in documents], ordered=False)
+        except BulkWriteError as e:
+            failed = bulk_failures(output, documents, e)
+        changes, note_counts = bulk_changes(documents, failed)
+        update_tag_counts(changes)
+        touch_notebooks(note_counts, time, changes)
+        cache.delete(*['notebook:{}'.format(nbid) for nbid in note_counts])
+    return json_response({'result' : output})
 
 # route for editing an existing note
 @app.route('/note/<int:nid>', methods=['PUT'])
 def edit_note(nid):
     output = []
-    new_title = request.json['title']
-    note = notes.find_one({'nid': nid})
-    # checks that the note exists, returns a 204 status if not
-    if note:
-        title = request.json.get('title')
-        body = request.json.get('body')
-        tags = request.json.get('tags')
-        data = {'lastModified': datetime.utcnow()}
-        # check the values passed in the body for the correct type
-        if isinstance(title, str):
-            data["title"] = title
-        elif title:
-            missing_or_invalid_key()
+    title = request.json.get('title')
+    body = request.json.get('body')
+    tags = request.json.get('tags')
+    data = {'lastModified': datetime.utcnow()}
+    # check the values passed in the body for the correct type
+    if isinstance(title, str):
+        data["title"] = title
+    elif title:
+        missing_or_invalid_key()
 
-        if isinstance(body, str):
-            data["body"] = body
-        elif body:
-            missing_or_invalid_key()
+    if isinstance(body, str):
+        data["body"] = body
+    elif body:
+        missing_or_invalid_key()
 
-        if isinstance(tags, list):
-            data["tags"] = tags
-        elif tags:
-            missing_or_invalid_key()
+    if isinstance(tags, list):
+        data["tags"] = tags
+    elif tags:
+        missing_or_invalid_key()
 
-        # updates the selected note and returns the updated note
-        notes.update_one({'nid': nid}, {'$set': data})
-        updated_note = notes.find_one({'nid': nid})
-        output.append({
-            'nid': updated_note['nid'], 
-            'title' : updated_note['title'],
-            'nbid': updated_note['nbid'],
-            'body': updated_note['body'],
-            'tags': updated_note['tags'],
-            'created': updated_note['created'],
-            'lastModified': updated_note['lastModified']
-        })
-        return jsonify({'result' : output})
+    # updates the selected note in a single round trip, reading the note as it
+    # was before the update so changes to its tags can be counted
+    note = notes.find_one_and_update(
+        {'nid': nid},
+        {'$set': dict(data, seq=change_seqs.reserve())},
+        projection=note_projection(NOTE_FIELDS),
+        return_document=ReturnDocument.BEFORE)
+    # checks that the note exists, returns a 204 status if not
+    if note:
+        changes = {}
+        if 'tags' in data:
+            tag_changes(changes, note['nbid'], note['tags'], -1)
+            update_tag_counts(tag_changes(changes, note['nbid'], data['tags'], 1))
+        # applies the update to the note read before it, which gives the note as written
+        note.update(data)
+        touch_notebooks({note['nbid']: 0}, data['lastModified'], changes)
+        cache.delete('note:{}'.format(nid), 'notebook:{}'.format(note['nbid']))
+        output.append(note_output(note))
+        return json_response({'result' : output})
     else:
         no_content()
 
@@ -289,15 +1467,37 @@ def edit_note(nid):
 @app.route('/note/<int:nid>', methods=['DELETE'])
 def delete_note(nid):
     output = []
-    note = notes.find_one({'nid': nid})
-    # checks that the note exists, returns a 204 status if not
+    # deletes and returns the selected note
+    note = notes.find_one_and_delete({'nid': nid}, projection={'_id': False, 'nid': True, 'title': True, 'nbid': True, 'tags': True})
+    # checks that the note existed, returns a 204 status if not
     if note:
-        # deletes and returns the selected note
-        notes.delete_one({'nid': nid})
+        time = datetime.utcnow()
+        add_tombstones([nid], note['nbid'], time)
+        changes = tag_changes({}, note['nbid'], note['tags'], -1)
+        update_tag_counts(changes)
+        touch_notebooks({note['nbid']: -1}, time, changes)
+        cache.delete('note:{}'.format(nid), 'notebook:{}'.format(note['nbid']))
         output.append({'nid': note['nid'], 'title' : note['title']})
-        return jsonify({'result' : output})
+        return json_response({'result' : output})
     else:
         no_content()
 
+# route for checking how often the note and notebook cache is used
+@app.route('/cache', methods=['GET'])
+def get_cache_stats():
+    return json_response({'result' : [cache.stats()]})
+
+# route for checking the database connection pool of this process
+@app.route('/db/pool', methods=['GET'])
+def get_pool_stats():
+    return json_response({'result' : pool_stats.stats()})
+
+# route for the request and database metrics of this process in Prometheus' text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not app.config['METRICS']:
+        abort(404)
+    return Response(request_metrics.render(pool_stats), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=False)
@@ -0,0 +1,600 @@
+# asynchronous entry point serving the /notebook, /note, /tags and /job routes
+# of app.py with the Motor driver, so waiting on the database does not hold a
+# thread, and the notebook event streams, which would each hold one in app.py;
+# the process statistics routes (/cache, /db/pool and /metrics), response
+# caching and the maintenance thread resuming stale jobs are only in app.py
+#
+#   pip install -r requirements-async.txt
+#   uvicorn asgi:app --host 0.0.0.0 --port 5000
+#
+# it shares the database, id counters and maintained tag counts and notebook
+# versions with app.py, so both can serve the same data side by side; the
+# queries and updates are built by the same functions, only the I/O differs
+from app import (app as flask_app, cache, dumps, mongo_options, IdAllocator, int_arg, page_args, note_fields, page_cursor, page_result,
+    list_document, query_etag, note_etag, notebook_etag, tag_changes, tag_count_requests, tag_count_retries, empty_tag_counts,
+    removed_tag_changes, tombstones, top_tags_cursor, touch_request, tag_count_output, tag_counts_cursor, notebook_summary,
+    note_output, note_projection, valid_new_note, stream_args, stream_cursor, notes_chunk, changes_args, check_sync_token,
+    changed_cursor, deleted_cursor, changes_document, search_args, search_cursor, search_document, request_too_large,
+    add_ndjson_item, json_array_items, bulk_new_notes, bulk_documents, number_bulk_notes, bulk_failures, bulk_changes,
+    delete_args, delete_batch_cursor, deleted_notebook_head, delete_job, job_progress, job_done, job_failed, Note, NOTE_FIELDS)
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from datetime import datetime
+from events import EventBus, create_feed
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException as WerkzeugHTTPException
+from werkzeug.http import http_date, parse_accept_header, parse_date, parse_etags
+import asyncio
+import bson
+
+config = flask_app.config
+db = None
+notebook_ids = None
+note_ids = None
+job_ids = None
+change_seqs = None
+# the notes as undecoded BSON, for clients that accept application/bson
+raw_notes = None
+# the background delete jobs running in this process
+delete_jobs = set()
+event_bus = EventBus(config['EVENTS_QUEUE_SIZE'])
+events = create_feed(config['EVENTS_BACKEND'], event_bus, NOTE_FIELDS, flask_app.logger)
+
+
+class JSONResponse(Response):
+    media_type = 'application/json'
+
+    # uses the same encoder as app.py, so datetimes are written the same way
+    def render(self, content):
+        return dumps(content)
+
+def no_content():
+    raise HTTPException(204)
+
+def missing_or_invalid_key():
+    raise HTTPException(400, '400: Request body has missing or invalid parameters')
+
+def invalid_parameter():
+    raise HTTPException(400, '400: Request has missing or invalid query parameters')
+
+def missing_notebook():
+    raise HTTPException(400, '400: Invalid notebook')
+
+async def http_exception(request, exc):
+    if exc.status_code == 204:
+        return Response(status_code=204)
+    return Response(exc.detail, status_code=exc.status_code, media_type='application/json')
+
+# answers the errors raised by the helpers shared with app.py, which abort with
+# a Flask response, with the same status and body
+async def werkzeug_exception(request, exc):
+    if exc.response is None:
+        return Response(exc.description, status_code=exc.code)
+    return Response(exc.response.get_data(), status_code=exc.response.status_code, media_type='application/json')
+
+# hands out ids from the same counter documents as IdAllocator in app.py, with
+# the same block bookkeeping
+class AsyncIdAllocator(IdAllocator):
+    def __init__(self, collection, field, block_size=1):
+        super(AsyncIdAllocator, self).__init__(collection, field, block_size)
+        self.lock = asyncio.Lock()
+
+    async def seed(self):
+        latest = await db[self.collection].find_one(**self.latest_query())
+        if latest:
+            try:
+                await db.counters.update_one(*self.seed_update(latest), upsert=True)
+            except DuplicateKeyError:
+                await db.counters.update_one(*self.seed_update(latest))
+        self.seeded = True
+
+    async def take(self, count):
+        if not self.seeded:
+            await self.seed()
+        counter = await db.counters.find_one_and_update(**self.take_update(count))
+        return counter['seq'] - count + 1
+
+    async def reserve(self, count=1):
+        async with self.lock:
+            if count > 1 or self.block_size == 1:
+                return await self.take(count)
+            if self.block_empty():
+                return self.from_block(await self.take(self.block_size))
+            return self.from_block()
+
+# creates the client and allocators once the server's event loop is running,
+# since both are bound to the loop they are created on
+async def connect():
+    global db, notebook_ids, note_ids, job_ids, change_seqs, raw_notes
+    options = mongo_options()
+    # the change streams each keep a connection waiting for changes, so they
+    # get their own on top of the ones requests use
+    options['maxPoolSize'] += events.connections
+    db = AsyncIOMotorClient(config['MONGO_URI'], **options).get_default_database()
+    notebook_ids = AsyncIdAllocator('notebooks', 'nbid', config['ID_BLOCK_SIZE'])
+    note_ids = AsyncIdAllocator('notes', 'nid', config['ID_BLOCK_SIZE'])
+    job_ids = AsyncIdAllocator('jobs', 'jobid')
+    change_seqs = AsyncIdAllocator('notes', 'seq')
+    raw_notes = db.notes.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+
+async def add_tombstones(nids, nbid, time):
+    seq = await change_seqs.reserve(len(nids))
+    await db.deleted_notes.insert_many(tombstones(nids, nbid, seq, time))
+    for i, nid in enumerate(nids):
+        events.publish({'type': 'delete_note', 'nbid': nbid, 'nid': nid, 'seq': seq + i})
+
+async def update_tag_counts(changes):
+    requests = tag_count_requests(changes)
+    if not requests:
+        return
+    try:
+        await db.tag_counts.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        await db.tag_counts.bulk_write(tag_count_retries(requests, e), ordered=False)
+    cleanup = empty_tag_counts(changes)
+    if cleanup:
+        await db.tag_counts.delete_many(cleanup)
+
+async def top_tags(nbid):
+    return tag_count_output(await top_tags_cursor(db.tag_counts, nbid).to_list(None))
+
+async def touch_notebooks(note_counts, time, changes=()):
+    retagged = set(nbid for nbid, tag in changes)
+    requests = [touch_request(nbid, change, time, await top_tags(nbid) if nbid in retagged else None)
+        for nbid, change in note_counts.items()]
+    if requests:
+        await db.notebooks.bulk_write(requests, ordered=False)
+
+async def request_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        missing_or_invalid_key()
+    return data
+
+# reads ?limit= and ?after=, every list is read a page at a time so no request
+# holds a whole collection in memory, MAX_PAGE_SIZE entries when no limit is given
+def list_args(request):
+    limit, after = page_args(request.query_params)
+    if limit is None:
+        limit = config['MAX_PAGE_SIZE']
+    return limit, after
+
+async def find_page(collection, query, key, limit, after, projection=None):
+    documents = await page_cursor(collection, query, key, after, projection).limit(limit + 1).to_list(None)
+    return page_result(documents, key, limit)
+
+# the type the client accepts best, as Flask's request.accept_mimetypes.best
+def best_accept(request):
+    return parse_accept_header(request.headers.get('accept'), MIMEAccept).best
+
+def wants_bson(request):
+    return best_accept(request) == 'application/bson'
+
+# reads a page of notes holding the given fields, as undecoded BSON documents
+# that are copied into the response as they are when the client accepts
+# application/bson, and as Note records otherwise
+async def find_notes_page(request, query, limit, after, fields):
+    if wants_bson(request):
+        return await find_page(raw_notes, query, 'nid', limit, after, note_projection(fields))
+    note_data, next_after = await find_page(db.notes, query, 'nid', limit, after, note_projection(fields))
+    return [note_output(n, fields) for n in note_data], next_after
+
+def list_response(request, output, limit, next_after):
+    document = list_document(output, limit, next_after)
+    if wants_bson(request):
+        return Response(bson.encode(document), media_type='application/bson')
+    return JSONResponse(document)
+
+# sets the ETag and Last-Modified headers the same way app.py does, returning
+# a 304 response instead when If-None-Match or If-Modified-Since show the
+# client already has this version
+def set_validators(request, response, etag, last_modified):
+    etag = query_etag(etag, request.url.query.encode('utf-8'), wants_bson(request))
+    headers = {'ETag': '"{}"'.format(etag)}
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        unchanged = parse_etags(if_none_match).contains_weak(etag)
+    else:
+        since = parse_date(request.headers.get('if-modified-since'))
+        unchanged = since is not None and last_modified is not None and last_modified.replace(microsecond=0) <= since
+    if unchanged:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return response
+
+def not_modified(request, etag, last_modified):
+    response = set_validators(request, Response(), etag, last_modified)
+    if response.status_code == 304:
+        return response
+
+async def get_all_notebooks(request):
+    limit, after = list_args(request)
+    nb_entries, next_after = await find_page(db.notebooks, {}, 'nbid', limit, after)
+    output = [notebook_summary(nb) for nb in nb_entries]
+    return list_response(request, output, limit, next_after)
+
+async def get_one_notebook(request):
+    nbid = request.path_params['nbid']
+    limit, after = list_args(request)
+    fields = note_fields(request.query_params)
+    nb = await db.notebooks.find_one({'nbid': nbid})
+    if not nb:
+        no_content()
+    # answers with a 304 status before reading any notes if the client is up to date
+    unchanged = not_modified(request, notebook_etag(nb), nb.get('lastModified'))
+    if unchanged:
+        return unchanged
+    note_data, next_after = await find_notes_page(request, {'nbid': nbid}, limit, after, fields)
+    output = [{'nbid': nb['nbid'], 'name': nb['name'], 'notes': note_data}]
+    return set_validators(request, list_response(request, output, limit, next_after), notebook_etag(nb), nb.get('lastModified'))
+
+async def get_one_notebook_by_tag(request):
+    nbid = request.path_params['nbid']
+    tag = request.path_params['tag']
+    tags = [tag] + request.query_params.getlist('tag')
+    match = request.query_params.get('match', 'any')
+    if match not in ('any', 'all'):
+        invalid_parameter()
+    limit, after = list_args(request)
+    fields = note_fields(request.query_params)
+    nb = await db.notebooks.find_one({'nbid': nbid})
+    if not nb:
+        no_content()
+    if len(tags) == 1:
+        tag_query = tag
+    elif match == 'all':
+        tag_query = {'$all': tags}
+    else:
+        tag_query = {'$in': tags}
+    note_data, next_after = await find_page(db.notes, {'nbid': nbid, 'tags': tag_query}, 'nid', limit, after, note_projection(fields))
+    output = [{'nbid': nb['nbid'], 'name': nb['name'], 'notes': [note_output(n, fields) for n in note_data]}]
+    return list_response(request, output, limit, next_after)
+
+async def post_notebook(request):
+    name = (await request_json(request)).get('name')
+    if not name:
+        missing_or_invalid_key()
+    nbid = await notebook_ids.reserve()
+    await db.notebooks.insert_one({'name': name, 'nbid': nbid, 'version': 1, 'lastModified': datetime.utcnow(), 'noteCount': 0, 'topTags': []})
+    return JSONResponse({'result': [{'nbid': nbid, 'name' : name}]})
+
+async def edit_notebook(request):
+    nbid = request.path_params['nbid']
+    new_name = (await request_json(request)).get('name')
+    if not isinstance(new_name, str):
+        missing_or_invalid_key()
+    updated_nb = await db.notebooks.find_one_and_update(
+        {'nbid': nbid},
+        {'$set': {'name': new_name, 'lastModified': datetime.utcnow()}, '$inc': {'version': 1}},
+        projection={'_id': False, 'nbid': True, 'name': True},
+        return_document=ReturnDocument.AFTER)
+    if not updated_nb:
+        no_content()
+    cache.delete('notebook:{}'.format(nbid))
+    events.publish({'type': 'edit_notebook', 'nbid': nbid, 'name': updated_nb['name']})
+    return JSONResponse({'result': [{'nbid': updated_nb['nbid'], 'name' : updated_nb['name']}]})
+
+# deletes the notes of a notebook a batch at a time and yields the ids of each batch
+async def delete_notebook_notes(nbid):
+    while True:
+        nids = [n['nid'] for n in await delete_batch_cursor(db.notes, nbid).to_list(None)]
+        if not nids:
+            return
+        await db.notes.delete_many({'nid': {'$in': nids}})
+        await add_tombstones(nids, nbid, datetime.utcnow())
+        cache.delete(*['note:{}'.format(nid) for nid in nids])
+        yield nids
+
+# deletes the notes of a notebook in a task, recording progress on the job
+async def run_delete_job(jobid, nbid):
+    try:
+        async for nids in delete_notebook_notes(nbid):
+            await db.jobs.update_one(*job_progress(jobid, len(nids)))
+        await db.jobs.update_one(*job_done(jobid))
+    except Exception as e:
+        await db.jobs.update_one(*job_failed(jobid, e))
+
+# starts a delete job if fewer than MAX_DELETE_JOBS are running in this
+# process, otherwise leaves it for app.py's workers to resume once it is stale
+def start_delete_job(jobid, nbid):
+    if len(delete_jobs) < config['MAX_DELETE_JOBS']:
+        task = asyncio.ensure_future(run_delete_job(jobid, nbid))
+        delete_jobs.add(task)
+        task.add_done_callback(delete_jobs.discard)
+
+# yields the deleted notebook as app.py's stream_deleted_notebook does; the
+# server keeps iterating after a client disconnects, so the cascade finishes
+async def stream_deleted_notebook(nb):
+    yield deleted_notebook_head(nb)
+    separator = b''
+    async for nids in delete_notebook_notes(nb['nbid']):
+        yield separator + b', '.join(b'%d' % nid for nid in nids)
+        separator = b', '
+    yield b']}]}'
+
+# deletes the notebook and then its notes a batch at a time, ?notes=ids streams
+# their ids and ?background=1 deletes them in a job followed at /job/<jobid>
+async def delete_notebook(request):
+    nbid = request.path_params['nbid']
+    mode, background = delete_args(request.query_params)
+    nb = await db.notebooks.find_one_and_delete({'nbid': nbid}, projection={'_id': False, 'nbid': True, 'name': True})
+    if not nb:
+        no_content()
+    cache.delete('notebook:{}'.format(nbid))
+    await update_tag_counts(removed_tag_changes(await db.tag_counts.find({'nbid': nbid}).to_list(None)))
+    await db.tag_counts.delete_many({'nbid': nbid})
+    if background:
+        jobid = await job_ids.reserve()
+        await db.jobs.insert_one(delete_job(jobid, nbid, datetime.utcnow()))
+        start_delete_job(jobid, nbid)
+        return JSONResponse({'result': [{'nbid': nb['nbid'], 'name' : nb['name'], 'job': jobid}]}, status_code=202)
+    if mode == 'ids':
+        return StreamingResponse(stream_deleted_notebook(nb), media_type='application/json')
+    deleted = 0
+    async for nids in delete_notebook_notes(nbid):
+        deleted += len(nids)
+    return JSONResponse({'result': [{'nbid': nb['nbid'], 'name' : nb['name'], 'deletedNotes': deleted}]})
+
+# yields the notes of a cursor as app.py's stream_notes does, reading
+# STREAM_CHUNK_SIZE notes at a time
+async def stream_notes(cursor, ndjson, fields):
+    if not ndjson:
+        yield b'{"result": ['
+    written = 0
+    while True:
+        chunk = await cursor.to_list(config['STREAM_CHUNK_SIZE'])
+        if not chunk:
+            break
+        yield notes_chunk(chunk, ndjson, fields, written)
+        written += len(chunk)
+    if not ndjson:
+        yield b']}'
+
+# ?stream=1 or ?stream=ndjson (or an Accept: application/x-ndjson header)
+# streams the notes straight from the cursor, without a page size
+async def get_all_notes(request):
+    fields = note_fields(request.query_params)
+    stream, ndjson = stream_args(request.query_params, best_accept(request))
+    if stream:
+        limit, after = page_args(request.query_params)
+        media_type = 'application/x-ndjson' if ndjson else 'application/json'
+        return StreamingResponse(stream_notes(stream_cursor(db.notes, limit, after, fields), ndjson, fields), media_type=media_type)
+    limit, after = list_args(request)
+    output, next_after = await find_notes_page(request, {}, limit, after, fields)
+    return list_response(request, output, limit, next_after)
+
+# always reads from the primary, as app.py does
+async def get_note_changes(request):
+    since, limit, fields = changes_args(request.query_params)
+    if since:
+        check_sync_token(since, await db.counters.find_one({'_id': 'purgedSeq'}))
+    changed = await changed_cursor(db.notes, since, limit, fields).to_list(None)
+    deleted = await deleted_cursor(db.deleted_notes, since, limit).to_list(None)
+    return JSONResponse(changes_document(changed, deleted, since, limit, fields))
+
+async def search_notes(request):
+    terms, nbid, limit, offset, fields = search_args(request.query_params)
+    note_entries = await search_cursor(db.notes, terms, nbid, limit, offset, fields).to_list(None)
+    return JSONResponse(search_document(note_entries, limit, offset, fields))
+
+async def get_tags(request):
+    nbid = int_arg('nbid', request.query_params)
+    if nbid is not None and not await db.notebooks.find_one({'nbid': nbid}, {'_id': True}):
+        no_content()
+    entries = await tag_counts_cursor(db.tag_counts, nbid).to_list(None)
+    return JSONResponse({'result': tag_count_output(entries)})
+
+async def get_job(request):
+    job = await db.jobs.find_one({'jobid': request.path_params['jobid']}, {'_id': False})
+    if not job:
+        no_content()
+    return JSONResponse({'result': [job]})
+
+async def get_one_note(request):
+    nid = request.path_params['nid']
+    fields = note_fields(request.query_params)
+    note = await db.notes.find_one({'nid': nid}, note_projection(fields + ('lastModified',)))
+    if not note:
+        no_content()
+    return set_validators(request, JSONResponse({'result': [note_output(note, fields)]}), note_etag(nid, note['lastModified']), note['lastModified'])
+
+async def post_note(request):
+    data = await request_json(request)
+    title = data.get('title')
+    body = data.get('body', '')
+    tags = data.get('tags', [])
+    nbid = data.get('nbid')
+    if not valid_new_note(title, body, tags, nbid):
+        missing_or_invalid_key()
+    if not await db.notebooks.find_one({'nbid': nbid}, {'_id': True}):
+        missing_notebook()
+    time = datetime.utcnow()
+    new_note = Note.new(await note_ids.reserve(), title, nbid, body, tags, time)
+    new_note['seq'] = await change_seqs.reserve()
+    await db.notes.insert_one(new_note)
+    changes = tag_changes({}, nbid, tags, 1)
+    await update_tag_counts(changes)
+    await touch_notebooks({nbid: 1}, time, changes)
+    cache.delete('notebook:{}'.format(nbid))
+    output = note_output(new_note)
+    events.publish({'type': 'post_note', 'nbid': nbid, 'nid': new_note['nid'], 'seq': new_note['seq'], 'note': output})
+    return JSONResponse({'result': [output]})
+
+# reads the notes of a bulk request as app.py's bulk_note_items does, from a
+# JSON array or one JSON note per line, no further than MAX_CONTENT_LENGTH bytes
+async def bulk_note_items(request):
+    max_size = config['MAX_CONTENT_LENGTH']
+    length = request.headers.get('content-length')
+    if length is not None and length.isdigit() and int(length) > max_size:
+        request_too_large()
+    media_type = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    ndjson = media_type == 'application/x-ndjson'
+    if not ndjson and not (media_type == 'application/json' or media_type.startswith('application/') and media_type.endswith('+json')):
+        missing_or_invalid_key()
+    size = 0
+    chunks = []
+    rest = b''
+    items = []
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_size:
+            request_too_large()
+        if ndjson:
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                add_ndjson_item(items, line)
+        else:
+            chunks.append(chunk)
+    if ndjson:
+        add_ndjson_item(items, rest)
+        return items
+    return json_array_items(b''.join(chunks))
+
+async def post_notes_bulk(request):
+    output, new_notes = bulk_new_notes(await bulk_note_items(request))
+    nbids = list(set(note['nbid'] for index, note in new_notes))
+    existing = set(nb['nbid'] for nb in await db.notebooks.find({'nbid': {'$in': nbids}}, {'nbid': True}).to_list(None))
+    documents = bulk_documents(output, new_notes, existing)
+    if documents:
+        time = datetime.utcnow()
+        number_bulk_notes(output, documents, await note_ids.reserve(len(documents)), await change_seqs.reserve(len(documents)), time)
+        failed = set()
+        try:
+            await db.notes.insert_many([note for index, note in documents], ordered=False)
+        except BulkWriteError as e:
+            failed = bulk_failures(output, documents, e)
+        changes, note_counts = bulk_changes(documents, failed)
+        await update_tag_counts(changes)
+        await touch_notebooks(note_counts, time, changes)
+        cache.delete(*['notebook:{}'.format(nbid) for nbid in note_counts])
+        for index, note in documents:
+            if index not in failed:
+                events.publish({'type': 'post_note', 'nbid': note['nbid'], 'nid': note['nid'], 'seq': note['seq'], 'note': note_output(note)})
+    return JSONResponse({'result': output})
+
+async def edit_note(request):
+    nid = request.path_params['nid']
+    body = await request_json(request)
+    data = {'lastModified': datetime.utcnow()}
+    for field, kind in (('title', str), ('body', str), ('tags', list)):
+        value = body.get(field)
+        if isinstance(value, kind):
+            data[field] = value
+        elif value:
+            missing_or_invalid_key()
+    data['seq'] = await change_seqs.reserve()
+    note = await db.notes.find_one_and_update(
+        {'nid': nid},
+        {'$set': data},
+        projection=note_projection(NOTE_FIELDS),
+        return_document=ReturnDocument.BEFORE)
+    if not note:
+        no_content()
+    changes = {}
+    if 'tags' in data:
+        tag_changes(changes, note['nbid'], note['tags'], -1)
+        await update_tag_counts(tag_changes(changes, note['nbid'], data['tags'], 1))
+    note.update(data)
+    await touch_notebooks({note['nbid']: 0}, data['lastModified'], changes)
+    cache.delete('note:{}'.format(nid), 'notebook:{}'.format(note['nbid']))
+    output = note_output(note)
+    events.publish({'type': 'edit_note', 'nbid': note['nbid'], 'nid': nid, 'seq': data['seq'], 'note': output})
+    return JSONResponse({'result': [output]})
+
+async def delete_note(request):
+    nid = request.path_params['nid']
+    note = await db.notes.find_one_and_delete({'nid': nid}, projection={'_id': False, 'nid': True, 'title': True, 'nbid': True, 'tags': True})
+    if not note:
+        no_content()
+    time = datetime.utcnow()
+    await add_tombstones([nid], note['nbid'], time)
+    changes = tag_changes({}, note['nbid'], note['tags'], -1)
+    await update_tag_counts(changes)
+    await touch_notebooks({note['nbid']: -1}, time, changes)
+    cache.delete('note:{}'.format(nid), 'notebook:{}'.format(note['nbid']))
+    return JSONResponse({'result': [{'nid': note['nid'], 'title' : note['title']}]})
+
+# writes a subscription's events as server-sent events until the client goes
+# away, with a keepalive comment whenever none arrive for EVENTS_HEARTBEAT
+# seconds; waiting for an event holds no thread
+async def stream_events(subscription, disconnected):
+    try:
+        yield b': connected\n\n'
+        while not subscription.closed:
+            event = await subscription.get(config['EVENTS_HEARTBEAT'])
+            if await disconnected():
+                break
+            if event is None:
+                yield b': keepalive\n\n'
+                continue
+            frame = b''
+            if event.get('seq') is not None:
+                frame += 'id: {}\n'.format(event['seq']).encode('utf-8')
+            frame += 'event: {}\n'.format(event['type']).encode('utf-8')
+            yield frame + b'data: ' + dumps(event) + b'\n\n'
+    finally:
+        event_bus.unsubscribe(subscription)
+
+# route for subscribing to the notes created, edited and deleted in the
+# notebook given by ?nbid=; it sits under /note so it cannot hide a tag route
+async def get_note_events(request):
+    nbid = int_arg('nbid', request.query_params)
+    if nbid is None:
+        invalid_parameter()
+    # returns a 204 status code if the notebook does not exist
+    if not await db.notebooks.find_one({'nbid': nbid}, {'_id': True}):
+        no_content()
+    events.start(db)
+    subscription = event_bus.subscribe(nbid)
+    return StreamingResponse(stream_events(subscription, request.is_disconnected), media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# compresses like GZipMiddleware but leaves the event stream alone, whose
+# events the compressor would hold back until it had enough to write
+class CompressionMiddleware(GZipMiddleware):
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == '/note/events':
+            await self.app(scope, receive, send)
+        else:
+            await super(CompressionMiddleware, self).__call__(scope, receive, send)
+
+app = Starlette(
+    routes=[
+        Route('/notebook', get_all_notebooks, methods=['GET']),
+        Route('/notebook', post_notebook, methods=['POST']),
+        Route('/notebook/{nbid:int}', get_one_notebook, methods=['GET']),
+        Route('/notebook/{nbid:int}', edit_notebook, methods=['PUT']),
+        Route('/notebook/{nbid:int}', delete_notebook, methods=['DELETE']),
+        Route('/notebook/{nbid:int}/{tag}', get_one_notebook_by_tag, methods=['GET']),
+        Route('/tags', get_tags, methods=['GET']),
+        Route('/job/{jobid:int}', get_job, methods=['GET']),
+        Route('/note', get_all_notes, methods=['GET']),
+        Route('/note', post_note, methods=['POST']),
+        Route('/note/bulk', post_notes_bulk, methods=['POST']),
+        Route('/note/changes', get_note_changes, methods=['GET']),
+        Route('/note/search', search_notes, methods=['GET']),
+        Route('/note/events', get_note_events, methods=['GET']),
+        Route('/note/{nid:int}', get_one_note, methods=['GET']),
+        Route('/note/{nid:int}', edit_note, methods=['PUT']),
+        Route('/note/{nid:int}', delete_note, methods=['DELETE']),
+    ],
+    exception_handlers={HTTPException: http_exception, WerkzeugHTTPException: werkzeug_exception},
+    # Starlette only offers gzip, compressed from the same size as app.py
+    middleware=[Middleware(CompressionMiddleware, minimum_size=config['COMPRESS_MIN_SIZE'])] if config['COMPRESSION'] else [],
+    on_startup=[connect],
+)
@@ -0,0 +1,365 @@
+#!flask/bin/python
+# measures the latency of the create and edit routes, run it before and after a
+# change to compare them
+#
+#   python bench.py --requests 500 --output before.json
+#
+# by default requests go through app.test_client() against the database
+# configured in app.py, --url sends them to a running server instead so
+# launchers can be compared, e.g. `python app.py` against gunicorn
+#
+#   python bench.py --url http://localhost:5000 --concurrency 16
+#
+# --serialisation skips the routes and times encoding note payloads with
+# Flask's encoder and with app.dumps instead, for bodies of several sizes
+#
+#   python bench.py --serialisation
+#
+# --allocations measures the memory allocated per note when a page of notes is
+# decoded and prepared for the encoder, as dicts rebuilt field by field and as
+# the Note records the routes use
+#
+#   python bench.py --allocations
+#
+# --lists creates notebooks of 10k and 100k notes and compares reading them as
+# JSON with reading them as raw BSON (Accept: application/bson)
+#
+#   python bench.py --lists --requests 10
+#
+# --suite seeds a dataset of --notebooks notebooks of --notes notes each and
+# sends --requests requests to every route at --concurrency, e.g.
+#
+#   python bench.py --suite --notebooks 1000 --notes 1000 --concurrency 16 --output suite.json
+#
+# --seed fixes the random choices, so two runs send the same requests
+#
+# the notebooks and notes it creates are deleted again when it finishes
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import json
+import random
+import time
+import tracemalloc
+import requests
+
+
+# sends requests to a running server with the same interface as AppClient
+class HttpClient(object):
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.session.request(method, self.url + path, json=body, headers=headers)
+        return response.status_code, response.content
+
+class AppClient(object):
+    def __init__(self):
+        from app import app
+        self.client = app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        response = self.client.open(path, method=method, data=json.dumps(body), content_type='application/json', headers=headers)
+        return response.status_code, response.get_data()
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+def summarise(samples, elapsed):
+    return {
+        'requests': len(samples),
+        'throughput': round(len(samples) / elapsed, 1),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+    }
+
+# sends a JSON request and returns the decoded result with the time it took
+def timed_request(client, method, path, body):
+    start = time.perf_counter()
+    status, text = client.request(method, path, body)
+    elapsed = time.perf_counter() - start
+    if status != 200:
+        raise RuntimeError('{} {} returned {}'.format(method, path, status))
+    return json.loads(text)['result'], elapsed
+
+# creates and edits count notebooks and notes, recording each request's latency
+def run_client(client, count, samples):
+    nbids = []
+    nids = []
+    try:
+        for i in range(count):
+            result, elapsed = timed_request(client, 'POST', '/notebook', {'name': 'Bench {}'.format(i)})
+            samples['POST /notebook'].append(elapsed)
+            nbids.append(result[0]['nbid'])
+
+            result, elapsed = timed_request(client, 'PUT', '/notebook/{}'.format(nbids[-1]), {'name': 'Edited {}'.format(i)})
+            samples['PUT /notebook/<nbid>'].append(elapsed)
+
+            result, elapsed = timed_request(client, 'POST', '/note', {
+                'title': 'Note {}'.format(i),
+                'nbid': nbids[0],
+                'body': 'So Many Things ' * 20,
+                'tags': ['bench', 'tag{}'.format(i % 10)]
+            })
+            samples['POST /note'].append(elapsed)
+            nids.append(result[0]['nid'])
+
+            result, elapsed = timed_request(client, 'PUT', '/note/{}'.format(nids[-1]), {'title': 'Edited {}'.format(i)})
+            samples['PUT /note/<nid>'].append(elapsed)
+    finally:
+        for nbid in nbids:
+            client.request('DELETE', '/notebook/{}'.format(nbid))
+
+def run(count, url=None, concurrency=1):
+    samples = {
+        'POST /notebook': [],
+        'PUT /notebook/<nbid>': [],
+        'POST /note': [],
+        'PUT /note/<nid>': [],
+    }
+    clients = [HttpClient(url) if url else AppClient() for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(run_client, client, count // concurrency, samples) for client in clients]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    return dict((route, summarise(route_samples, elapsed)) for route, route_samples in samples.items())
+
+# a page of notes shaped like the ones the routes return, with bodies of body_size bytes
+def sample_notes(count, body_size):
+    now = datetime.utcnow()
+    return {'result': [{
+        'nid': i,
+        'title': 'Note {}'.format(i),
+        'nbid': 1,
+        'body': ('So Many Things ' * (body_size // 15 + 1))[:body_size],
+        'tags': ['bench', 'tag{}'.format(i % 10)],
+        'created': now,
+        'lastModified': now,
+    } for i in range(count)]}
+
+# times encoding pages of 100 notes with Flask's encoder and with app.dumps
+def run_serialisation(count, sizes=(200, 2000, 20000)):
+    from app import app, dumps
+    from flask import json
+    results = {}
+    with app.app_context():
+        for size in sizes:
+            data = sample_notes(100, size)
+            for name, encode in (('flask', lambda: json.dumps(data).encode('utf-8')), ('fast', lambda: dumps(data))):
+                samples = []
+                start = time.perf_counter()
+                for i in range(count):
+                    before = time.perf_counter()
+                    encode()
+                    samples.append(time.perf_counter() - before)
+                results['{} {}B'.format(name, size)] = summarise(samples, time.perf_counter() - start)
+    return results
+
+# measures the peak memory allocated per note while decoding a page of count
+# notes from BSON and building the list the encoder is given
+def run_allocations(count, body_size=2000):
+    from app import NOTE_FIELDS, note_output, notes
+    import bson
+    page = b''.join(bson.encode(n) for n in sample_notes(count, body_size)['result'])
+    paths = {
+        'dict': lambda: [{field: n[field] for field in NOTE_FIELDS} for n in bson.decode_all(page)],
+        'Note': lambda: [note_output(n) for n in bson.decode_all(page, notes.codec_options)],
+    }
+    results = {}
+    for name, path in paths.items():
+        tracemalloc.start()
+        output = path()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'notes': len(output), 'bytes_per_note': peak // len(output)}
+    return results
+
+# times reading a notebook of each size as JSON and as raw BSON, count times each
+def run_lists(count, url=None, sizes=(10000, 100000)):
+    client = HttpClient(url) if url else AppClient()
+    # listing every field keeps the responses out of the response cache
+    fields = 'fields=title,nbid,body,tags,created,lastModified'
+    formats = (('json', {'Accept': 'application/json'}), ('bson', {'Accept': 'application/bson'}))
+    results = {}
+    for size in sizes:
+        nbid = None
+        try:
+            result, elapsed = timed_request(client, 'POST', '/notebook', {'name': 'Bench {} notes'.format(size)})
+            nbid = result[0]['nbid']
+            notes = sample_notes(size, 500)['result']
+            for start in range(0, size, 10000):
+                client.request('POST', '/note/bulk', [
+                    {'title': n['title'], 'nbid': nbid, 'body': n['body'], 'tags': n['tags']} for n in notes[start:start + 10000]])
+            for name, headers in formats:
+                samples = []
+                start = time.perf_counter()
+                for i in range(count):
+                    before = time.perf_counter()
+                    status, content = client.request('GET', '/notebook/{}?{}'.format(nbid, fields), headers=headers)
+                    samples.append(time.perf_counter() - before)
+                    if status != 200:
+                        raise RuntimeError('GET /notebook/{} returned {}'.format(nbid, status))
+                results['GET /notebook/<nbid> {} {}'.format(size, name)] = summarise(samples, time.perf_counter() - start)
+        finally:
+            if nbid is not None:
+                client.request('DELETE', '/notebook/{}'.format(nbid))
+    return results
+
+WORDS = ('meeting', 'budget', 'recipe', 'travel', 'project', 'idea', 'draft', 'review', 'garden', 'invoice',
+         'holiday', 'reading', 'workout', 'release', 'design', 'shopping', 'lecture', 'journal', 'deadline', 'family')
+TAGS = ['tag{}'.format(i) for i in range(50)]
+
+# a note with a few tags, the lower numbered ones more common, and a body of
+# 100 bytes to 5KB
+def random_note(rng, nbid):
+    return {
+        'title': ' '.join(rng.choice(WORDS) for i in range(rng.randint(1, 5))).capitalize(),
+        'nbid': nbid,
+        'body': ' '.join(rng.choice(WORDS) for i in range(rng.randint(15, 700))),
+        'tags': sorted(set(TAGS[min(int(rng.expovariate(0.15)), len(TAGS) - 1)] for i in range(rng.randint(0, 4)))),
+    }
+
+# creates notebook_count notebooks of note_count notes each, returning the ids
+# of the notebooks and of their notes
+def seed(client, rng, notebook_count, note_count):
+    nbids = []
+    nids = []
+    for i in range(notebook_count):
+        result, elapsed = timed_request(client, 'POST', '/notebook', {'name': 'Suite {}'.format(i)})
+        nbids.append(result[0]['nbid'])
+        for start in range(0, note_count, 10000):
+            batch = [random_note(rng, nbids[-1]) for j in range(min(10000, note_count - start))]
+            result, elapsed = timed_request(client, 'POST', '/note/bulk', batch)
+            nids.extend(item['nid'] for item in result if item['status'] == 201)
+    return nbids, nids
+
+# the requests sent to each route, as functions of the random generator, the
+# seeded ids and a client's own notebook returning (method, path, body); list
+# routes read a page at a time as clients do
+SUITE = [
+    ('GET /notebook', lambda rng, data, own: ('GET', '/notebook?limit=100', None)),
+    ('GET /notebook/<nbid>', lambda rng, data, own: ('GET', '/notebook/{}?limit=100'.format(rng.choice(data['nbids'])), None)),
+    ('GET /notebook/<nbid>/<tag>', lambda rng, data, own: ('GET', '/notebook/{}/{}?limit=100'.format(rng.choice(data['nbids']), rng.choice(TAGS[:10])), None)),
+    ('GET /tags?nbid=', lambda rng, data, own: ('GET', '/tags?nbid={}'.format(rng.choice(data['nbids'])), None)),
+    ('GET /tags', lambda rng, data, own: ('GET', '/tags', None)),
+    ('POST /notebook', lambda rng, data, own: ('POST', '/notebook', {'name': 'Suite notebook'})),
+    ('PUT /notebook/<nbid>', lambda rng, data, own: ('PUT', '/notebook/{}'.format(own['nbid']), {'name': 'Edited'})),
+    ('GET /note', lambda rng, data, own: ('GET', '/note?limit=100&after={}'.format(rng.choice(data['nids'])), None)),
+    ('GET /note?stream=', lambda rng, data, own: ('GET', '/note?stream=ndjson&limit=100&after={}'.format(rng.choice(data['nids'])), None)),
+    ('GET /note/changes', lambda rng, data, own: ('GET', '/note/changes?limit=100', None)),
+    ('GET /note/search', lambda rng, data, own: ('GET', '/note/search?q={}&nbid={}'.format(rng.choice(WORDS), rng.choice(data['nbids'])), None)),
+    ('GET /note/<nid>', lambda rng, data, own: ('GET', '/note/{}'.format(rng.choice(data['nids'])), None)),
+    ('POST /note', lambda rng, data, own: ('POST', '/note', random_note(rng, own['nbid']))),
+    ('POST /note/bulk', lambda rng, data, own: ('POST', '/note/bulk', [random_note(rng, own['nbid']) for i in range(100)])),
+    ('PUT /note/<nid>', lambda rng, data, own: ('PUT', '/note/{}'.format(rng.choice(data['nids'])), {'tags': random_note(rng, 0)['tags']})),
+    ('DELETE /note/<nid>', lambda rng, data, own: ('DELETE', '/note/{}'.format(own['nids'].pop()), None)),
+    ('DELETE /notebook/<nbid>', lambda rng, data, own: ('DELETE', '/notebook/{}'.format(own['nbids'].pop()), None)),
+    ('DELETE /notebook/<nbid>?notes=ids', lambda rng, data, own: ('DELETE', '/notebook/{}?notes=ids'.format(own['ids_nbids'].pop()), None)),
+    ('GET /job/<jobid>', lambda rng, data, own: ('GET', '/job/{}'.format(own['jobid']), None)),
+    ('GET /cache', lambda rng, data, own: ('GET', '/cache', None)),
+    ('GET /db/pool', lambda rng, data, own: ('GET', '/db/pool', None)),
+    ('GET /metrics', lambda rng, data, own: ('GET', '/metrics', None)),
+]
+
+# creates what a client's writes and deletes work on: a notebook of its own to
+# add and edit notes in, count notes and two sets of count notebooks to delete
+# and a background delete job to read
+def prepare_client(client, rng, count):
+    own = {}
+    result, elapsed = timed_request(client, 'POST', '/notebook', {'name': 'Suite client'})
+    own['nbid'] = result[0]['nbid']
+    result, elapsed = timed_request(client, 'POST', '/note/bulk', [random_note(rng, own['nbid']) for i in range(count)])
+    own['nids'] = [item['nid'] for item in result]
+    own['nbids'] = [timed_request(client, 'POST', '/notebook', {'name': 'Suite delete'})[0][0]['nbid'] for i in range(count)]
+    own['ids_nbids'] = [timed_request(client, 'POST', '/notebook', {'name': 'Suite delete'})[0][0]['nbid'] for i in range(count)]
+    result, elapsed = timed_request(client, 'POST', '/notebook', {'name': 'Suite job'})
+    status, content = client.request('DELETE', '/notebook/{}?background=1'.format(result[0]['nbid']))
+    own['jobid'] = json.loads(content)['result'][0]['job']
+    own['created'] = []
+    return own
+
+def run_suite_client(client, rng, data, own, route, count, samples):
+    for i in range(count):
+        method, path, body = route(rng, data, own)
+        start = time.perf_counter()
+        status, content = client.request(method, path, body)
+        samples.append(time.perf_counter() - start)
+        if status >= 400:
+            raise RuntimeError('{} {} returned {}'.format(method, path, status))
+        # keeps the notebooks the suite creates so they are deleted afterwards
+        if (method, path) == ('POST', '/notebook'):
+            own['created'].append(json.loads(content)['result'][0]['nbid'])
+
+# seeds the dataset, then sends count requests to each route in turn from
+# concurrency clients, and deletes everything it created
+def run_suite(count, url=None, concurrency=1, notebook_count=10, note_count=100, seed_value=0):
+    clients = [HttpClient(url) if url else AppClient() for i in range(concurrency)]
+    rngs = [random.Random(seed_value + i) for i in range(concurrency)]
+    per_client = max(count // concurrency, 1)
+    nbids = []
+    owns = []
+    results = {}
+    try:
+        data = {}
+        data['nbids'], data['nids'] = seed(clients[0], random.Random(seed_value), notebook_count, note_count)
+        nbids.extend(data['nbids'])
+        for client, rng in zip(clients, rngs):
+            owns.append(prepare_client(client, rng, per_client))
+            nbids.append(owns[-1]['nbid'])
+        for name, route in SUITE:
+            samples = []
+            start = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as executor:
+                futures = [executor.submit(run_suite_client, client, rng, data, own, route, per_client, samples)
+                           for client, rng, own in zip(clients, rngs, owns)]
+                for future in futures:
+                    future.result()
+            results[name] = summarise(samples, time.perf_counter() - start)
+    finally:
+        for own in owns:
+            nbids.extend(own['nbids'] + own['ids_nbids'] + own['created'])
+        for nbid in nbids:
+            clients[0].request('DELETE', '/notebook/{}'.format(nbid))
+    results['dataset'] = {'notebooks': notebook_count, 'notes': note_count, 'concurrency': concurrency, 'seed': seed_value}
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure throughput and p50/p99 latency of the create and edit routes.')
+    parser.add_argument('--requests', type=int, default=200, help='requests sent to each route')
+    parser.add_argument('--url', help='address of a running server, requests go through the test client when not given')
+    parser.add_argument('--concurrency', type=int, default=1, help='clients sending requests at once')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--serialisation', action='store_true', help='time encoding note payloads instead of sending requests')
+    parser.add_argument('--allocations', action='store_true', help='measure memory allocated per listed note instead of sending requests')
+    parser.add_argument('--lists', action='store_true', help='compare reading large notebooks as JSON and as raw BSON')
+    parser.add_argument('--suite', action='store_true', help='seed a dataset and send requests to every route')
+    parser.add_argument('--notebooks', type=int, default=10, help='notebooks seeded by --suite')
+    parser.add_argument('--notes', type=int, default=100, help='notes in each notebook seeded by --suite')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random choices made by --suite')
+    args = parser.parse_args()
+
+    if args.allocations:
+        results = run_allocations(args.requests)
+        for path, summary in sorted(results.items()):
+            print('{:<8} {:>8} notes   {:>8} bytes per note'.format(path, summary['notes'], summary['bytes_per_note']))
+    else:
+        if args.serialisation:
+            results = run_serialisation(args.requests)
+        elif args.lists:
+            results = run_lists(args.requests, args.url)
+        elif args.suite:
+            results = run_suite(args.requests, args.url, args.concurrency, args.notebooks, args.notes, args.seed)
+        else:
+            results = run(args.requests, args.url, args.concurrency)
+        for route, summary in sorted(results.items()):
+            if 'throughput' in summary:
+                print('{:<28} {:>8.1f} req/s   p50 {:>8.3f} ms   p95 {:>8.3f} ms   p99 {:>8.3f} ms'.format(
+                    route, summary['throughput'], summary['p50_ms'], summary['p95_ms'], summary['p99_ms']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
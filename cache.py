@@ -0,0 +1,146 @@
+# caches for serialised responses, keyed by strings such as 'note:1'
+from collections import OrderedDict
+import threading
+import time
+
+
+# in-process cache holding at most max_size entries for ttl seconds each,
+# evicting the least recently used entry when it is full
+class LRUCache(object):
+    name = 'memory'
+
+    def __init__(self, max_size=10000, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'backend': self.name, 'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+# cache shared by every process through a Redis-style client, so an edit made
+# by one worker invalidates the entry for all of them
+class SharedCache(object):
+    name = 'redis'
+
+    def __init__(self, client, ttl=5, prefix='nevernote:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        self.client.flushdb()
+
+    def stats(self):
+        return {'backend': self.name, 'hits': self.hits, 'misses': self.misses}
+
+
+# in-process stand-in for a Redis server, supporting the commands SharedCache
+# uses, for running the shared backend without a server
+class LocalStore(object):
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.time()):
+                return None
+            return entry[0]
+
+    def set(self, key, value, ex=None):
+        with self.lock:
+            self.values[key] = (value, time.time() + ex if ex else None)
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.values.pop(key, None)
+
+    def flushdb(self):
+        with self.lock:
+            self.values.clear()
+
+
+# cache that never stores anything, used when caching is turned off
+class NullCache(object):
+    name = 'none'
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+# creates the cache named by backend: 'memory', 'redis' or 'none', the redis
+# backend connects to url, or to a LocalStore when url is 'local://'
+def create_cache(backend, url=None, max_size=10000, ttl=5):
+    if backend == 'memory':
+        return LRUCache(max_size, ttl)
+    if backend == 'redis':
+        if url == 'local://':
+            return SharedCache(LocalStore(), ttl)
+        import redis
+        return SharedCache(redis.Redis.from_url(url), ttl)
+    if backend == 'none':
+        return NullCache()
+    raise ValueError('Unknown cache backend: {}'.format(backend))
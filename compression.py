@@ -0,0 +1,95 @@
+# compressors for response bodies, named by their Content-Encoding, brotli and
+# zstd are only offered when the brotli and zstandard packages are installed
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    # returns everything compressed so far, so a streamed chunk reaches the client
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor(object):
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# the encodings that can be used, most preferred first
+def available_encodings():
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+def create_compressor(encoding, level):
+    if encoding == 'gzip':
+        return GzipCompressor(level)
+    if encoding == 'br':
+        return BrotliCompressor(level)
+    if encoding == 'zstd':
+        return ZstdCompressor(level)
+    raise ValueError('Unknown encoding: {}'.format(encoding))
+
+def compress(data, encoding, level):
+    compressor = create_compressor(encoding, level)
+    return compressor.compress(data) + compressor.finish()
+
+# compresses the chunks of a streamed response as they are produced, flushing
+# after each one so the client does not wait for the compressor's buffer to fill
+def compress_stream(chunks, encoding, level):
+    compressor = create_compressor(encoding, level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            yield compressor.compress(chunk) + compressor.flush()
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
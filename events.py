@@ -0,0 +1,143 @@
+# note events pushed by the async server to the subscribers of a notebook,
+# published by its routes or read from MongoDB change streams; everything here
+# runs on the server's event loop, so an idle subscriber holds no thread
+from pymongo.errors import PyMongoError
+import asyncio
+
+
+# a subscriber's queue of events, closed when it falls too far behind so the
+# client reconnects and catches up through GET /note/changes
+class Subscription(object):
+    def __init__(self, nbid, size):
+        self.nbid = nbid
+        self.events = asyncio.Queue(size)
+        self.closed = False
+
+    def put(self, event):
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.closed = True
+
+    # returns the next event, or None if there was none within timeout seconds
+    async def get(self, timeout):
+        if not self.events.empty():
+            return self.events.get_nowait()
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+# hands each event to the subscribers of its notebook in this process
+class EventBus(object):
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self.subscriptions = {}
+
+    def subscribe(self, nbid):
+        subscription = Subscription(nbid, self.queue_size)
+        self.subscriptions.setdefault(nbid, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.nbid, set())
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            self.subscriptions.pop(subscription.nbid, None)
+
+    def publish(self, event):
+        for subscription in list(self.subscriptions.get(event['nbid'], ())):
+            subscription.put(event)
+
+
+# publishes the events the routes report straight to the bus, which only
+# reaches subscribers connected to the same process; meant for tests and
+# single process servers
+class LocalFeed(object):
+    name = 'local'
+    connections = 0
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def start(self, db):
+        pass
+
+    def publish(self, event):
+        self.bus.publish(event)
+
+
+# reads the events from change streams on the notes, deleted_notes and
+# notebooks collections, so every process sees the writes of all of them;
+# needs a replica set, and a task per collection started on first use
+class ChangeStreamFeed(object):
+    name = 'changestream'
+    streams = (
+        ('notes', [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]),
+        ('deleted_notes', [{'$match': {'operationType': 'insert'}}]),
+        ('notebooks', [{'$match': {'operationType': 'update', 'updateDescription.updatedFields.name': {'$exists': True}}}]),
+    )
+    # each stream keeps a connection waiting on the server for new changes
+    connections = len(streams)
+
+    def __init__(self, bus, note_fields, logger, retry_seconds=1):
+        self.bus = bus
+        self.note_fields = note_fields
+        self.logger = logger
+        self.retry_seconds = retry_seconds
+        self.started = False
+
+    def start(self, db):
+        if self.started:
+            return
+        self.started = True
+        for collection, pipeline in self.streams:
+            asyncio.ensure_future(self.watch(db, collection, pipeline))
+
+    # the routes' own reports are ignored, the change streams deliver them
+    def publish(self, event):
+        pass
+
+    # follows one collection, retrying every retry_seconds when the stream
+    # fails; a failure is logged once until the stream opens again, such as on
+    # a standalone server, where subscribers would otherwise only get keepalives
+    async def watch(self, db, collection, pipeline):
+        resume_token = None
+        failing = False
+        while True:
+            try:
+                async with db[collection].watch(pipeline, full_document='updateLookup', resume_after=resume_token) as stream:
+                    failing = False
+                    async for change in stream:
+                        event = self.event(collection, change)
+                        if event:
+                            self.bus.publish(event)
+                        resume_token = stream.resume_token
+            except PyMongoError as e:
+                if not failing:
+                    self.logger.warning('change stream on %s failed, retrying every %s s: %s', collection, self.retry_seconds, e)
+                    failing = True
+                await asyncio.sleep(self.retry_seconds)
+
+    def event(self, collection, change):
+        document = change.get('fullDocument')
+        # the note may have been deleted again before it was looked up
+        if document is None:
+            return None
+        if collection == 'notes':
+            kind = 'post_note' if change['operationType'] == 'insert' else 'edit_note'
+            return {'type': kind, 'nbid': document['nbid'], 'nid': document['nid'], 'seq': document.get('seq'), 'note': dict((field, document[field]) for field in self.note_fields)}
+        if collection == 'deleted_notes':
+            return {'type': 'delete_note', 'nbid': document['nbid'], 'nid': document['nid'], 'seq': document['seq']}
+        return {'type': 'edit_notebook', 'nbid': document['nbid'], 'name': document['name']}
+
+
+# creates the feed named by backend: 'local' or 'changestream', which reports
+# failed change streams to logger
+def create_feed(backend, bus, note_fields, logger):
+    if backend == 'local':
+        return LocalFeed(bus)
+    if backend == 'changestream':
+        return ChangeStreamFeed(bus, note_fields, logger)
+    raise ValueError('Unknown events backend: {}'.format(backend))
@@ -0,0 +1,49 @@
+# production server settings, used with
+#
+#   gunicorn -c gunicorn.conf.py app:app
+#
+# every setting can be overridden from the environment
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# most of a request is spent waiting on the database, so each worker runs a
+# few threads and there are two workers per core
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# each thread needs at most one database connection at a time, so the pool
+# of every worker is sized to its threads instead of PyMongo's default of 100,
+# plus one connection for each background thread of the worker: the
+# maintenance thread, the startup index build, which holds its connection for
+# the whole build, and up to MAX_DELETE_JOBS background deletes; the notebook
+# event streams and the change streams feeding them are served by asgi.py
+background_threads = 2 + int(os.environ.get('MAX_DELETE_JOBS', 2))
+os.environ.setdefault('MONGO_MAX_POOL_SIZE', str(threads + background_threads))
+
+# the memory cache is kept by each worker, so an edit served by one would leave
+# the others answering with the old note until their entry expires; caching is
+# off with several workers unless a shared backend such as redis is configured
+if workers > 1:
+    os.environ.setdefault('CACHE_BACKEND', 'none')
+
+# loads the app once before forking so workers share its memory and start fast
+preload_app = True
+
+# recycles workers now and then so slow leaks cannot build up, with jitter so
+# they do not all restart together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+
+
+def post_fork(server, worker):
+    from app import reset_after_fork
+    reset_after_fork()
@@ -0,0 +1,236 @@
+# listeners PyMongo reports database events to, and the request metrics
+# served in Prometheus' text format
+from pymongo.monitoring import CommandListener, ConnectionCheckOutFailedReason, ConnectionPoolListener
+import threading
+
+
+# counts the connections in each server's pool and how often checking one out
+# failed, so pool exhaustion shows up before requests start timing out
+class PoolStats(ConnectionPoolListener):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pools = {}
+
+    def count(self, address, name, change=1):
+        with self.lock:
+            pool = self.pools.setdefault('{}:{}'.format(*address), {
+                'open': 0,
+                'inUse': 0,
+                'created': 0,
+                'closed': 0,
+                'checkOuts': 0,
+                'checkOutFailures': 0,
+                'waitQueueTimeouts': 0,
+                'cleared': 0,
+            })
+            pool[name] += change
+
+    def stats(self):
+        with self.lock:
+            return [dict(pool, address=address) for address, pool in sorted(self.pools.items())]
+
+    def pool_created(self, event):
+        self.count(event.address, 'open', 0)
+
+    def pool_cleared(self, event):
+        self.count(event.address, 'cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.count(event.address, 'created')
+        self.count(event.address, 'open')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.count(event.address, 'closed')
+        self.count(event.address, 'open', -1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.count(event.address, 'checkOutFailures')
+        if event.reason == ConnectionCheckOutFailedReason.TIMEOUT:
+            self.count(event.address, 'waitQueueTimeouts')
+
+    def connection_checked_out(self, event):
+        self.count(event.address, 'checkOuts')
+        self.count(event.address, 'inUse')
+
+    def connection_checked_in(self, event):
+        self.count(event.address, 'inUse', -1)
+
+
+# the collection a command works on and the part of it selecting documents,
+# or the number of documents it inserts, kept for the slow command log instead
+# of the command itself, which may hold whole batches of notes
+def command_target(command_name, command):
+    collection = command.get(command_name)
+    if not isinstance(collection, str):
+        collection = None
+    for field in ('filter', 'query', 'pipeline'):
+        if field in command:
+            return collection, command[field], None
+    for field in ('updates', 'deletes'):
+        if command.get(field):
+            return collection, command[field][0].get('q'), None
+    if 'documents' in command:
+        return collection, None, len(command['documents'])
+    return collection, None, None
+
+# the keys and operators of a query or pipeline with every value replaced by
+# '?', so the log shows which documents were selected but none of their content
+def query_shape(query):
+    if isinstance(query, dict):
+        return dict((key, query_shape(value)) for key, value in query.items())
+    if isinstance(query, list) and query and all(isinstance(value, dict) for value in query):
+        return [query_shape(value) for value in query]
+    return '?'
+
+
+# counts and times the commands sent to the database by the current thread,
+# so each request can report how many round trips it made, and logs commands
+# slower than slow_ms by name, collection and query shape
+class CommandStats(CommandListener):
+    def __init__(self, logger, slow_ms=100):
+        self.logger = logger
+        self.slow_ms = slow_ms
+        self.local = threading.local()
+
+    # starts counting the commands of a new request on this thread
+    def begin(self):
+        self.local.count = 0
+        self.local.seconds = 0.0
+        self.local.commands = []
+
+    # returns the number of commands sent since begin() and the time they took,
+    # along with each command's name and duration
+    def end(self):
+        return getattr(self.local, 'count', 0), getattr(self.local, 'seconds', 0.0), getattr(self.local, 'commands', [])
+
+    def started(self, event):
+        self.local.target = command_target(event.command_name, event.command)
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    def record(self, event):
+        seconds = event.duration_micros / 1000000.0
+        if hasattr(self.local, 'count'):
+            self.local.count += 1
+            self.local.seconds += seconds
+            self.local.commands.append((event.command_name, seconds))
+        if seconds * 1000 >= self.slow_ms:
+            collection, query, documents = getattr(self.local, 'target', None) or (None, None, None)
+            detail = query_shape(query) if documents is None else '{} documents'.format(documents)
+            self.logger.warning('slow %s on %s took %.1f ms: %s', event.command_name, collection, seconds * 1000, detail)
+        self.local.target = None
+
+
+# cumulative histogram in Prometheus' format, counting observations no larger
+# than each bucket's upper bound
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, total))
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, self.count))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels.rstrip(','), self.sum))
+        lines.append('{}_count{{{}}} {}'.format(name, labels.rstrip(','), self.count))
+        return lines
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COMMAND_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+# per-route request latency, response size and database commands, plus the
+# duration of each kind of command
+class RequestMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = {}
+        self.latency = {}
+        self.sizes = {}
+        self.commands = {}
+        self.command_latency = {}
+
+    def histogram(self, histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    # records one request, size is None for streamed responses whose size is
+    # not known when they start
+    def observe(self, method, route, status, seconds, size, command_count, commands):
+        with self.lock:
+            key = (method, route, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.histogram(self.latency, (method, route), LATENCY_BUCKETS).observe(seconds)
+            if size is not None:
+                self.histogram(self.sizes, (method, route), SIZE_BUCKETS).observe(size)
+            self.histogram(self.commands, (method, route), COMMAND_BUCKETS).observe(command_count)
+            for name, command_seconds in commands:
+                self.histogram(self.command_latency, (name,), LATENCY_BUCKETS).observe(command_seconds)
+
+    # renders the metrics, and the counts of pool_stats, in Prometheus' text format
+    def render(self, pool_stats=None):
+        lines = []
+        with self.lock:
+            lines.append('# HELP nevernote_requests_total Requests served by route and status.')
+            lines.append('# TYPE nevernote_requests_total counter')
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append('nevernote_requests_total{{method="{}",route="{}",status="{}"}} {}'.format(method, route, status, count))
+            for name, help, histograms in (
+                    ('nevernote_request_duration_seconds', 'Time taken to answer requests by route.', self.latency),
+                    ('nevernote_response_size_bytes', 'Size of response bodies by route.', self.sizes),
+                    ('nevernote_request_db_commands', 'Database commands sent per request by route.', self.commands)):
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} histogram'.format(name))
+                for (method, route), histogram in sorted(histograms.items()):
+                    lines.extend(histogram.lines(name, 'method="{}",route="{}",'.format(method, route)))
+            lines.append('# HELP nevernote_db_command_duration_seconds Time taken by database commands by command.')
+            lines.append('# TYPE nevernote_db_command_duration_seconds histogram')
+            for (name,), histogram in sorted(self.command_latency.items()):
+                lines.extend(histogram.lines('nevernote_db_command_duration_seconds', 'command="{}",'.format(name)))
+        if pool_stats is not None:
+            pools = pool_stats.stats()
+            for field, name, kind in (
+                    ('open', 'nevernote_pool_connections_open', 'gauge'),
+                    ('inUse', 'nevernote_pool_connections_in_use', 'gauge'),
+                    ('checkOutFailures', 'nevernote_pool_check_out_failures_total', 'counter'),
+                    ('waitQueueTimeouts', 'nevernote_pool_wait_queue_timeouts_total', 'counter')):
+                lines.append('# TYPE {} {}'.format(name, kind))
+                for pool in pools:
+                    lines.append('{}{{address="{}"}} {}'.format(name, pool['address'], pool[field]))
+        return '\n'.join(lines) + '\n'
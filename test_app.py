@@ -1,13 +1,43 @@
-from app import app, notebooks, notes
+from app import app, notebooks, notes, counters, jobs, tag_counts, deleted_notes, cache, notebook_ids, note_ids, job_ids, change_seqs, IdAllocator, Note, NOTE_FIELDS, note_output, note_projection, cache_response, resume_stale_jobs, delete_job_slots, ensure_indexes, missing_indexes, build_indexes, index_report, purge_tombstones, backfill_change_seqs, rebuild_tag_counts, rebuild_notebook_summaries
 import json
+import bson
+import gzip
 from datetime import datetime
 from freezegun import freeze_time
 import time
+import pytest
+from cache import LRUCache, SharedCache, LocalStore
+from flask import Response
+from monitoring import CommandStats
+from types import SimpleNamespace
+from events import EventBus, create_feed
+from pymongo.errors import PyMongoError
+import asyncio
 
 
-def clear_db_and_add_notebook():
+def clear_db():
 	notebooks.drop()
 	notes.drop()
+	counters.drop()
+	jobs.drop()
+	tag_counts.drop()
+	deleted_notes.drop()
+	notebook_ids.reset()
+	note_ids.reset()
+	job_ids.reset()
+	change_seqs.reset()
+	cache.clear()
+
+# restores any settings a test changes once it has finished
+@pytest.fixture
+def app_config():
+	saved = dict(app.config)
+	yield app.config
+	app.config.clear()
+	app.config.update(saved)
+
+def clear_db_and_add_notebook():
+	clear_db()
         
 	response = app.test_client().post(
 		'/notebook',
@@ -18,8 +48,7 @@ def clear_db_and_add_notebook():
 	return response
 
 def clear_db_and_add_notebook_and_note():
-	notebooks.drop()
-	notes.drop()
+	clear_db()
         
 	app.test_client().post(
 		'/notebook',
@@ -40,6 +69,7 @@ def clear_db_and_add_notebook_and_note():
 
 	return response
 
+@freeze_time('2019-01-02 03:04:05')
 def test_notebook_post():
 	clear_db_and_add_notebook()
 
@@ -51,11 +81,12 @@ def test_notebook_post():
 	data = json.loads(response.get_data(as_text=True))
 
 	assert response.status_code == 200
-	assert data['result'] == [{'name': 'Notebook 1', 'nbid': 1}]
+	assert data['result'] == [
+		{'name': 'Notebook 1', 'nbid': 1, 'noteCount': 0, 'lastModified': 'Wed, 02 Jan 2019 03:04:05 GMT', 'topTags': []}
+	]
 
 def test_notebook_post_missing_key_error():
-	notebooks.drop()
-	notes.drop()
+	clear_db()
         
 	response = app.test_client().post(
 		'/notebook',
@@ -65,6 +96,7 @@ def test_notebook_post_missing_key_error():
 
 	assert response.status_code == 400
 
+@freeze_time('2019-01-02 03:04:05')
 def test_notebook_get_all():
 	clear_db_and_add_notebook()
 
@@ -82,8 +114,8 @@ def test_notebook_get_all():
 
 	assert response.status_code == 200
 	assert data['result'] == [
-		{'name': 'Notebook 1', 'nbid': 1},
-		{'name': 'Notebook 2', 'nbid': 2}
+		{'name': 'Notebook 1', 'nbid': 1, 'noteCount': 0, 'lastModified': 'Wed, 02 Jan 2019 03:04:05 GMT', 'topTags': []},
+		{'name': 'Notebook 2', 'nbid': 2, 'noteCount': 0, 'lastModified': 'Wed, 02 Jan 2019 03:04:05 GMT', 'topTags': []}
 	]
 
 @freeze_time('2019-01-02 03:04:05')
@@ -191,6 +223,50 @@ def test_notebook_get_notes_by_tag():
 		]}
 	]
 	
+def test_notebook_get_notes_by_multiple_tags():
+	clear_db_and_add_notebook_and_note()
+
+	app.test_client().post(
+		'/note',
+		data=json.dumps({
+			'title' : 'Note 2',
+			'nbid': 1,
+			'body': 'Even More Things',
+			'tags': ['better', 'best']
+		}),
+		content_type='application/json',
+	)
+
+	response = app.test_client().get(
+		'/notebook/1/good?tag=best',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert [n['nid'] for n in data['result'][0]['notes']] == [1, 2]
+
+	response = app.test_client().get(
+		'/notebook/1/better?tag=best&match=all',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert [n['nid'] for n in data['result'][0]['notes']] == [2]
+
+def test_notebook_get_notes_by_tag_invalid_match():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().get(
+		'/notebook/1/good?match=some',
+		content_type='application/json',
+	)
+
+	assert response.status_code == 400
+	
 def test_notebook_edit_one():
 	response = clear_db_and_add_notebook()
 
@@ -328,6 +404,122 @@ def test_notebook_delete_one_also_deletes_corresponding_notes():
 	assert response.status_code == 200
 	assert data['result'] == []
 
+def add_notes(count):
+	app.test_client().post(
+		'/note/bulk',
+		data=json.dumps([{'title' : 'Note {}'.format(i), 'nbid': 1} for i in range(count)]),
+		content_type='application/json',
+	)
+
+def test_notebook_delete_one_returns_deleted_note_count(app_config):
+	clear_db_and_add_notebook()
+	add_notes(5)
+	app_config['DELETE_BATCH_SIZE'] = 2
+
+	response = app.test_client().delete(
+		'/notebook/1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == [{'name': 'Notebook 1', 'nbid': 1, 'deletedNotes': 5}]
+	assert notes.count_documents({}) == 0
+
+def test_notebook_delete_one_streams_deleted_note_ids(app_config):
+	clear_db_and_add_notebook()
+	add_notes(5)
+	app_config['DELETE_BATCH_SIZE'] = 2
+
+	response = app.test_client().delete(
+		'/notebook/1?notes=ids',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == [{'name': 'Notebook 1', 'nbid': 1, 'deletedNotes': [1, 2, 3, 4, 5]}]
+	assert notes.count_documents({}) == 0
+
+def test_notebook_delete_one_in_background(app_config):
+	clear_db_and_add_notebook()
+	add_notes(5)
+	app_config['DELETE_BATCH_SIZE'] = 2
+
+	response = app.test_client().delete(
+		'/notebook/1?background=1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 202
+	jobid = data['result'][0]['job']
+
+	for i in range(50):
+		response = app.test_client().get(
+			'/job/{}'.format(jobid),
+			content_type='application/json',
+		)
+		job = json.loads(response.get_data(as_text=True))['result'][0]
+		if job['status'] != 'running':
+			break
+		time.sleep(0.1)
+
+	assert job['status'] == 'done'
+	assert job['deletedNotes'] == 5
+	assert notes.count_documents({}) == 0
+
+def test_stale_delete_jobs_are_resumed(app_config):
+	clear_db_and_add_notebook()
+	add_notes(5)
+	app_config['DELETE_BATCH_SIZE'] = 2
+	# a job whose worker exited after the notebook was deleted but before its notes were
+	notebooks.delete_one({'nbid': 1})
+	jobs.insert_many([
+		{'jobid': 1, 'type': 'delete_notebook', 'nbid': 1, 'status': 'running', 'deletedNotes': 0, 'lastModified': datetime(2019, 1, 1)},
+		{'jobid': 2, 'type': 'delete_notebook', 'nbid': 2, 'status': 'running', 'deletedNotes': 0, 'lastModified': datetime.utcnow()},
+	])
+
+	resume_stale_jobs()
+
+	for i in range(50):
+		job = jobs.find_one({'jobid': 1})
+		if job['status'] != 'running':
+			break
+		time.sleep(0.1)
+
+	assert job['status'] == 'done'
+	assert job['deletedNotes'] == 5
+	assert job['resumed'] == 1
+	assert notes.count_documents({}) == 0
+	assert jobs.find_one({'jobid': 2})['status'] == 'running'
+
+def test_background_deletes_wait_for_a_free_slot():
+	clear_db_and_add_notebook()
+	add_notes(3)
+	held = 0
+	while delete_job_slots.acquire(blocking=False):
+		held += 1
+
+	try:
+		response = app.test_client().delete(
+			'/notebook/1?background=1',
+			content_type='application/json',
+		)
+		time.sleep(0.2)
+		job = jobs.find_one({'jobid': json.loads(response.get_data(as_text=True))['result'][0]['job']})
+
+		assert response.status_code == 202
+		assert job['status'] == 'running'
+		assert job['deletedNotes'] == 0
+		assert notes.count_documents({}) == 3
+	finally:
+		for i in range(held):
+			delete_job_slots.release()
+
 def test_notebook_delete_one_missing_notebook_response():
 	response = clear_db_and_add_notebook()
 
@@ -364,6 +556,39 @@ def test_note_post():
 		}
 	]
 
+def test_note_ids_are_not_reused_after_delete():
+	clear_db_and_add_notebook_and_note()
+
+	app.test_client().delete(
+		'/note/1',
+		content_type='application/json',
+	)
+	response = app.test_client().post(
+		'/note',
+		data=json.dumps({
+			'title' : 'Note 2',
+			'nbid': 1,
+			'body': 'Even More Things',
+			'tags': []
+		}),
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'][0]['nid'] == 2
+
+def test_id_allocator_reserves_blocks():
+	clear_db_and_add_notebook_and_note()
+
+	allocator = IdAllocator(notes, 'nid', block_size=10)
+
+	assert [allocator.reserve() for i in range(3)] == [2, 3, 4]
+	assert counters.find_one({'_id': 'nid'})['seq'] == 11
+	assert note_ids.reserve() == 12
+	assert allocator.reserve(5) == 13
+
 def test_notes_can_not_post_to_missing_notebooks():
 	clear_db_and_add_notebook()
 
@@ -443,6 +668,90 @@ def test_notes_can_not_post_with_invalid_nbid():
 
 	assert response.status_code == 400
 
+def test_note_post_bulk():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().post(
+		'/note/bulk',
+		data=json.dumps([
+			{'title' : 'Note 2', 'nbid': 1, 'tags': ['good']},
+			{'title' : 5, 'nbid': 1},
+			{'title' : 'Note 3', 'nbid': 2},
+			{'title' : 'Note 4', 'nbid': 1, 'body': 'Even More Things'}
+		]),
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert [r['status'] for r in data['result']] == [201, 400, 400, 201]
+	assert [r.get('nid') for r in data['result']] == [2, None, None, 3]
+
+	response = app.test_client().get(
+		'/note/3',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'][0]['title'] == 'Note 4'
+	assert data['result'][0]['body'] == 'Even More Things'
+
+def test_note_post_bulk_ndjson():
+	clear_db_and_add_notebook()
+
+	response = app.test_client().post(
+		'/note/bulk',
+		data='{"title": "Note 1", "nbid": 1}\nnot json\n{"title": "Note 2", "nbid": 1}\n',
+		content_type='application/x-ndjson',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert [r['status'] for r in data['result']] == [201, 400, 201]
+	assert notes.count_documents({'nbid': 1}) == 2
+
+def test_note_post_bulk_stops_reading_past_the_limits(app_config):
+	clear_db_and_add_notebook()
+	app_config['BULK_MAX_NOTES'] = 2
+
+	response = app.test_client().post(
+		'/note/bulk',
+		data='{"title": "Note 1", "nbid": 1}\n' * 3,
+		content_type='application/x-ndjson',
+	)
+
+	assert response.status_code == 400
+	assert notes.count_documents({}) == 0
+
+	app_config['BULK_MAX_NOTES'] = 10000
+	app_config['MAX_CONTENT_LENGTH'] = 100
+
+	for data, content_type in (
+			(json.dumps([{'title': 'Note {}'.format(i), 'nbid': 1} for i in range(5)]), 'application/json'),
+			('{"title": "Note 1", "nbid": 1}\n' * 5, 'application/x-ndjson')):
+		response = app.test_client().post(
+			'/note/bulk',
+			data=data,
+			content_type=content_type,
+		)
+
+		assert response.status_code == 413
+	assert notes.count_documents({}) == 0
+
+def test_note_post_bulk_requires_a_list():
+	clear_db_and_add_notebook()
+
+	response = app.test_client().post(
+		'/note/bulk',
+		data=json.dumps({'title' : 'Note 1', 'nbid': 1}),
+		content_type='application/json',
+	)
+
+	assert response.status_code == 400
+
 @freeze_time('2019-01-02 03:04:05')
 def test_note_get_all():
 	clear_db_and_add_notebook_and_note()
@@ -488,6 +797,105 @@ def test_note_get_all():
 		}
 	]
 
+@freeze_time('2019-01-02 03:04:05')
+def test_note_get_all_streamed():
+	clear_db_and_add_notebook_and_note()
+
+	app.test_client().post(
+		'/note',
+		data=json.dumps({'title' : 'Note 2', 'nbid': 1}),
+		content_type='application/json',
+	)
+
+	response = app.test_client().get(
+		'/note',
+		content_type='application/json',
+	)
+	expected = json.loads(response.get_data(as_text=True))['result']
+
+	response = app.test_client().get(
+		'/note?stream=1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == expected
+
+	response = app.test_client().get(
+		'/note',
+		headers={'Accept': 'application/x-ndjson'},
+	)
+
+	lines = response.get_data(as_text=True).splitlines()
+
+	assert response.status_code == 200
+	assert response.mimetype == 'application/x-ndjson'
+	assert [json.loads(line) for line in lines] == expected
+
+	for stream in ('0', 'yes'):
+		response = app.test_client().get(
+			'/note?stream={}'.format(stream),
+			content_type='application/json',
+		)
+
+		assert response.status_code == 400
+
+def test_note_get_all_paginated():
+	clear_db_and_add_notebook_and_note()
+
+	for title in ['Note 2', 'Note 3']:
+		app.test_client().post(
+			'/note',
+			data=json.dumps({'title' : title, 'nbid': 1}),
+			content_type='application/json',
+		)
+
+	response = app.test_client().get(
+		'/note?limit=2',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert [n['nid'] for n in data['result']] == [1, 2]
+	assert data['next'] == 2
+
+	response = app.test_client().get(
+		'/note?limit=2&after=2',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert [n['nid'] for n in data['result']] == [3]
+	assert data['next'] is None
+
+	response = app.test_client().get(
+		'/notebook/1?limit=1&after=1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert [n['nid'] for n in data['result'][0]['notes']] == [2]
+	assert data['next'] == 2
+
+def test_note_get_all_invalid_limit():
+	clear_db_and_add_notebook_and_note()
+
+	for query in ['limit=0', 'limit=many', 'after=first']:
+		response = app.test_client().get(
+			'/note?' + query,
+			content_type='application/json',
+		)
+
+		assert response.status_code == 400
+
 @freeze_time('2019-01-02 03:04:05')
 def test_note_get_one():
 	clear_db_and_add_notebook_and_note()
@@ -512,6 +920,36 @@ def test_note_get_one():
 		}
 	]
 
+def test_note_get_with_fields():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().get(
+		'/note/1?fields=title,tags',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == [{'nid': 1, 'title': 'Note 1', 'tags': ['good', 'better']}]
+
+	response = app.test_client().get(
+		'/notebook/1?fields=title',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'][0]['notes'] == [{'nid': 1, 'title': 'Note 1'}]
+
+	response = app.test_client().get(
+		'/note?fields=title,colour',
+		content_type='application/json',
+	)
+
+	assert response.status_code == 400
+
 def test_note_can_not_get_one_with_missing():
 	clear_db_and_add_notebook_and_note()
 
@@ -553,25 +991,50 @@ def test_note_edit_one():
 	assert edited_data['result'][0]['tags'] == ['better', 'best']
 	assert edited_data['result'][0]['lastModified'] != original_data['result'][0]['lastModified']
 
-def test_note_can_not_edit_one_if_note_is_missing():
+@freeze_time('2019-01-02 03:04:05')
+def test_note_edit_one_returns_updated_note():
 	clear_db_and_add_notebook_and_note()
 
 	response = app.test_client().put(
-		'/note/2',
-		data=json.dumps({
-			'title' : 'Note 2',
-			'body': 'Even More Things',
-			'tags': ['better', 'best'],
-		}),
+		'/note/1',
+		data=json.dumps({'body': 'Even More Things'}),
 		content_type='application/json',
 	)
 
-	assert response.status_code == 204
-
-def test_note_can_not_edit_one_if_title_is_invalid():
-	clear_db_and_add_notebook_and_note()
+	data = json.loads(response.get_data(as_text=True))
 
-	response = app.test_client().put(
+	assert response.status_code == 200
+	assert data['result'] == [
+		{
+			'title' : 'Note 1',
+			'nbid': 1,
+			'nid': 1,
+			'body': 'Even More Things',
+			'tags': ['good', 'better'],
+			'created': 'Wed, 02 Jan 2019 03:04:05 GMT', 
+			'lastModified': 'Wed, 02 Jan 2019 03:04:05 GMT'
+		}
+	]
+
+def test_note_can_not_edit_one_if_note_is_missing():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().put(
+		'/note/2',
+		data=json.dumps({
+			'title' : 'Note 2',
+			'body': 'Even More Things',
+			'tags': ['better', 'best'],
+		}),
+		content_type='application/json',
+	)
+
+	assert response.status_code == 204
+
+def test_note_can_not_edit_one_if_title_is_invalid():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().put(
 		'/note/1',
 		data=json.dumps({
 			'title' : 5,
@@ -692,3 +1155,887 @@ def test_note_delete_one_fails_if_note_is_missing():
 
 	assert response.status_code == 204
 
+def test_indexes_cover_lookups():
+	clear_db_and_add_notebook_and_note()
+	ensure_indexes()
+
+	assert notes.index_information()['nid']['unique']
+	assert notebooks.index_information()['nbid']['unique']
+
+	report = {entry['route']: entry for entry in index_report()}
+
+	assert report['GET /note/<nid>']['covered']
+	assert report['GET /notebook/<nbid>']['covered']
+	assert report['GET /notebook/<nbid>/<tag> notes']['indexes'] == ['nbid_tags']
+
+def test_index_build_over_duplicate_ids_is_logged_not_raised():
+	clear_db()
+	notes.insert_many([{'nid': 1, 'title': 'Note 1'}, {'nid': 1, 'title': 'Note 1 again'}])
+
+	missing = missing_indexes()
+
+	assert ('notes', [('nid', 1)], {'name': 'nid', 'unique': True}) in missing
+
+	build_indexes(missing)
+
+	assert 'nid' not in notes.index_information()
+	assert 'nbid_nid' in notes.index_information()
+	assert missing_indexes() == [index for index in missing if index[2]['name'] == 'nid']
+
+def test_note_reads_are_cached_until_edited():
+	clear_db_and_add_notebook_and_note()
+	hits = cache.stats().get('hits', 0)
+
+	for i in range(2):
+		response = app.test_client().get(
+			'/note/1',
+			content_type='application/json',
+		)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'][0]['title'] == 'Note 1'
+	assert cache.stats().get('hits', 0) == hits + 1
+
+	app.test_client().put(
+		'/note/1',
+		data=json.dumps({'title' : 'Note 2'}),
+		content_type='application/json',
+	)
+	response = app.test_client().get(
+		'/notebook/1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'][0]['notes'][0]['title'] == 'Note 2'
+
+	response = app.test_client().get(
+		'/note/1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'][0]['title'] == 'Note 2'
+
+def test_cache_response_drops_a_body_written_over_while_it_was_stored():
+	cache.clear()
+
+	with app.test_request_context('/note/1'):
+		cache_response('note:1', Response(b'{"result": []}', mimetype='application/json'), lambda: False)
+		cache_response('note:2', Response(b'{"result": []}', mimetype='application/json'), lambda: True)
+
+	assert cache.get('note:1') is None
+	assert cache.get('note:2') is not None
+
+def test_lru_cache_evicts_least_recently_used():
+	lru = LRUCache(max_size=2, ttl=60)
+	lru.set('note:1', b'1')
+	lru.set('note:2', b'2')
+	lru.get('note:1')
+	lru.set('note:3', b'3')
+
+	assert lru.get('note:2') is None
+	assert lru.get('note:1') == b'1'
+	assert lru.stats() == {'backend': 'memory', 'hits': 2, 'misses': 1, 'size': 2}
+
+def test_shared_cache_with_local_store():
+	shared = SharedCache(LocalStore(), ttl=60)
+	shared.set('note:1', b'1')
+
+	assert shared.get('note:1') == b'1'
+
+	shared.delete('note:1')
+
+	assert shared.get('note:1') is None
+	assert shared.stats() == {'backend': 'redis', 'hits': 1, 'misses': 1}
+
+def test_note_conditional_get():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().get(
+		'/note/1',
+		content_type='application/json',
+	)
+	etag = response.headers['ETag']
+	last_modified = response.headers['Last-Modified']
+
+	response = app.test_client().get(
+		'/note/1',
+		headers={'If-None-Match': etag},
+	)
+
+	assert response.status_code == 304
+	assert response.get_data() == b''
+
+	response = app.test_client().get(
+		'/note/1',
+		headers={'If-Modified-Since': last_modified},
+	)
+
+	assert response.status_code == 304
+
+	time.sleep(1)
+	app.test_client().put(
+		'/note/1',
+		data=json.dumps({'title' : 'Note 2'}),
+		content_type='application/json',
+	)
+	response = app.test_client().get(
+		'/note/1',
+		headers={'If-None-Match': etag},
+	)
+
+	assert response.status_code == 200
+	assert response.headers['ETag'] != etag
+
+def test_notebook_conditional_get_changes_with_notes():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().get(
+		'/notebook/1',
+		content_type='application/json',
+	)
+	etag = response.headers['ETag']
+
+	response = app.test_client().get(
+		'/notebook/1',
+		headers={'If-None-Match': etag},
+	)
+
+	assert response.status_code == 304
+
+	app.test_client().post(
+		'/note',
+		data=json.dumps({'title' : 'Note 2', 'nbid': 1}),
+		content_type='application/json',
+	)
+	response = app.test_client().get(
+		'/notebook/1',
+		headers={'If-None-Match': etag},
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert len(data['result'][0]['notes']) == 2
+
+def test_note_search():
+	clear_db_and_add_notebook_and_note()
+	ensure_indexes()
+
+	app.test_client().post(
+		'/notebook',
+		data=json.dumps({'name': 'Notebook 2'}),
+		content_type='application/json',
+	)
+	app.test_client().post(
+		'/note/bulk',
+		data=json.dumps([
+			{'title' : 'Shopping', 'nbid': 1, 'body': 'Things to buy'},
+			{'title' : 'Other things', 'nbid': 2, 'body': 'Nothing much'},
+			{'title' : 'Holiday', 'nbid': 1, 'body': 'Beach'}
+		]),
+		content_type='application/json',
+	)
+
+	response = app.test_client().get(
+		'/note/search?q=things',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'][0]['title'] == 'Other things'
+	assert sorted(n['nid'] for n in data['result']) == [1, 2, 3]
+	assert data['next'] is None
+
+	response = app.test_client().get(
+		'/note/search?q=things&nbid=1&limit=1&fields=title',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert len(data['result']) == 1
+	assert set(data['result'][0]) == {'nid', 'title', 'score'}
+	assert data['next'] == 1
+
+	for path in ('/note/search?q=', '/note/search?q=things&limit=0', '/note/changes?limit=0'):
+		response = app.test_client().get(
+			path,
+			content_type='application/json',
+		)
+
+		assert response.status_code == 400
+
+def test_tag_counts_follow_note_changes():
+	clear_db_and_add_notebook_and_note()
+
+	app.test_client().post(
+		'/notebook',
+		data=json.dumps({'name': 'Notebook 2'}),
+		content_type='application/json',
+	)
+	app.test_client().post(
+		'/note/bulk',
+		data=json.dumps([
+			{'title' : 'Note 2', 'nbid': 1, 'tags': ['better', 'best']},
+			{'title' : 'Note 3', 'nbid': 2, 'tags': ['good', 'good']}
+		]),
+		content_type='application/json',
+	)
+	app.test_client().put(
+		'/note/1',
+		data=json.dumps({'tags': ['good', 'best']}),
+		content_type='application/json',
+	)
+	app.test_client().delete(
+		'/note/2',
+		content_type='application/json',
+	)
+
+	response = app.test_client().get(
+		'/tags?nbid=1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == [{'tag': 'best', 'count': 1}, {'tag': 'good', 'count': 1}]
+
+	response = app.test_client().get(
+		'/tags',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == [{'tag': 'good', 'count': 2}, {'tag': 'best', 'count': 1}]
+
+	app.test_client().delete(
+		'/notebook/2',
+		content_type='application/json',
+	)
+	response = app.test_client().get(
+		'/tags',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'] == [{'tag': 'best', 'count': 1}, {'tag': 'good', 'count': 1}]
+	assert tag_counts.count_documents({'nbid': 2}) == 0
+
+	response = app.test_client().get(
+		'/tags?nbid=2',
+		content_type='application/json',
+	)
+
+	assert response.status_code == 204
+
+def test_tag_route_serves_tags_named_like_other_routes():
+	clear_db_and_add_notebook()
+
+	app.test_client().post(
+		'/note/bulk',
+		data=json.dumps([
+			{'title' : 'Note 1', 'nbid': 1, 'tags': ['tags']},
+			{'title' : 'Note 2', 'nbid': 1, 'tags': ['events']},
+		]),
+		content_type='application/json',
+	)
+
+	for tag, nid in (('tags', 1), ('events', 2)):
+		response = app.test_client().get(
+			'/notebook/1/{}'.format(tag),
+			content_type='application/json',
+		)
+
+		data = json.loads(response.get_data(as_text=True))
+
+		assert response.status_code == 200
+		assert [n['nid'] for n in data['result'][0]['notes']] == [nid]
+
+def test_notebook_summaries_follow_note_changes():
+	with freeze_time('2019-01-02 03:04:05'):
+		clear_db_and_add_notebook_and_note()
+
+	app.test_client().post(
+		'/note/bulk',
+		data=json.dumps([
+			{'title' : 'Note 2', 'nbid': 1, 'tags': ['better', 'best']},
+			{'title' : 'Note 3', 'nbid': 1, 'tags': ['better']}
+		]),
+		content_type='application/json',
+	)
+	app.test_client().delete(
+		'/note/1',
+		content_type='application/json',
+	)
+	with freeze_time('2019-01-03 03:04:05'):
+		app.test_client().put(
+			'/note/2',
+			data=json.dumps({'tags': ['best']}),
+			content_type='application/json',
+		)
+
+	response = app.test_client().get(
+		'/notebook',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == [{
+		'nbid': 1,
+		'name': 'Notebook 1',
+		'noteCount': 2,
+		'lastModified': 'Thu, 03 Jan 2019 03:04:05 GMT',
+		'topTags': [{'tag': 'best', 'count': 1}, {'tag': 'better', 'count': 1}]
+	}]
+
+def test_rebuild_tag_counts():
+	clear_db_and_add_notebook_and_note()
+	tag_counts.drop()
+
+	notebooks.update_one({'nbid': 1}, {'$unset': {'noteCount': True, 'topTags': True}})
+
+	rebuild_tag_counts()
+	rebuild_notebook_summaries()
+
+	response = app.test_client().get(
+		'/notebook',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'][0]['noteCount'] == 1
+	assert data['result'][0]['topTags'] == [{'tag': 'better', 'count': 1}, {'tag': 'good', 'count': 1}]
+
+	response = app.test_client().get(
+		'/tags?nbid=1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'] == [{'tag': 'better', 'count': 1}, {'tag': 'good', 'count': 1}]
+
+	response = app.test_client().get(
+		'/tags',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'] == [{'tag': 'better', 'count': 1}, {'tag': 'good', 'count': 1}]
+
+def test_asgi_routes_share_the_database():
+	pytest.importorskip('motor')
+	pytest.importorskip('starlette')
+	from starlette.testclient import TestClient
+	import asgi
+
+	clear_db_and_add_notebook_and_note()
+
+	with TestClient(asgi.app) as client:
+		response = client.post('/note', json={'title' : 'Note 2', 'nbid': 1, 'tags': ['good']})
+
+		assert response.status_code == 200
+		assert response.json()['result'][0]['nid'] == 2
+
+		response = client.get('/notebook/1?fields=title')
+
+		assert response.status_code == 200
+		assert response.json()['result'][0]['notes'] == [
+			{'nid': 1, 'title': 'Note 1'},
+			{'nid': 2, 'title': 'Note 2'}
+		]
+
+		assert response.json()['next'] is None
+
+		response = client.get('/note/1')
+
+		assert response.json()['result'][0]['created'].endswith(' GMT')
+		assert client.get('/note/1', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+		assert client.get('/note?limit=0').status_code == 400
+
+		assert client.get('/note/3').status_code == 204
+		assert client.post('/note', json={'title' : 'Note 3', 'nbid': 2}).status_code == 400
+
+	response = app.test_client().get(
+		'/tags?nbid=1',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'] == [{'tag': 'good', 'count': 2}, {'tag': 'better', 'count': 1}]
+
+def test_asgi_serves_the_other_note_routes():
+	pytest.importorskip('motor')
+	pytest.importorskip('starlette')
+	from starlette.testclient import TestClient
+	import asgi
+
+	clear_db_and_add_notebook()
+	ensure_indexes()
+
+	with TestClient(asgi.app) as client:
+		response = client.post('/note/bulk', json=[
+			{'title' : 'Shopping things', 'nbid': 1, 'tags': ['good']},
+			{'title' : 'Note 2', 'nbid': 2},
+		])
+
+		assert [item['status'] for item in response.json()['result']] == [201, 400]
+
+		response = client.post('/note/bulk', data=b'{"title": "Note 3", "nbid": 1}\n', headers={'Content-Type': 'application/x-ndjson'})
+
+		assert response.json()['result'][0]['nid'] == 2
+
+		assert client.get('/note/search?q=things&fields=title').json()['result'][0]['title'] == 'Shopping things'
+		assert [n['nid'] for n in client.get('/note/changes?fields=title').json()['result']] == [1, 2]
+		assert client.get('/tags?nbid=1').json()['result'] == [{'tag': 'good', 'count': 1}]
+		assert client.get('/note?stream=ndjson&fields=title').text == '{"nid":1,"title":"Shopping things"}\n{"nid":2,"title":"Note 3"}\n'
+
+		response = client.get('/note?fields=title', headers={'Accept': 'application/bson'})
+
+		assert bson.decode(response.content)['result'] == [{'nid': 1, 'title': 'Shopping things'}, {'nid': 2, 'title': 'Note 3'}]
+
+		response = client.delete('/notebook/1?notes=ids')
+
+		assert response.json()['result'][0]['deletedNotes'] == [1, 2]
+
+		client.post('/notebook', json={'name': 'Notebook 2'})
+		client.post('/note', json={'title' : 'Note 4', 'nbid': 2})
+		response = client.delete('/notebook/2?background=1')
+
+		assert response.status_code == 202
+		jobid = response.json()['result'][0]['job']
+
+		for i in range(50):
+			job = client.get('/job/{}'.format(jobid)).json()['result'][0]
+			if job['status'] != 'running':
+				break
+			time.sleep(0.1)
+
+		assert job['status'] == 'done'
+		assert job['deletedNotes'] == 1
+
+def test_pool_stats():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().get(
+		'/db/pool',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'][0]['open'] >= 1
+	assert data['result'][0]['checkOuts'] >= 1
+	assert data['result'][0]['inUse'] == 0
+
+def test_fast_json_matches_flask_encoder(app_config):
+	with freeze_time('2019-01-02 03:04:05.123456'):
+		clear_db_and_add_notebook_and_note()
+
+	results = []
+	for fast_json in (True, False):
+		app_config['FAST_JSON'] = fast_json
+		cache.clear()
+		response = app.test_client().get(
+			'/note/1',
+			content_type='application/json',
+		)
+		results.append(json.loads(response.get_data(as_text=True)))
+
+	assert results[0] == results[1]
+	assert results[0]['result'][0]['created'] == 'Wed, 02 Jan 2019 03:04:05 GMT'
+
+def test_note_output_returns_projected_notes_as_decoded():
+	clear_db_and_add_notebook_and_note()
+
+	note = notes.find_one({'nid': 1}, note_projection(NOTE_FIELDS))
+
+	assert isinstance(note, Note)
+	assert note_output(note) is note
+	assert note_output(note, ('nid', 'title')) == {'nid': 1, 'title': 'Note 1'}
+	assert note_output(Note(nid=1, title='x'), ('nid', 'body')) == {'nid': 1}
+
+def test_note_lists_as_raw_bson():
+	with freeze_time('2019-01-02 03:04:05'):
+		clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().get(
+		'/notebook/1',
+		headers={'Accept': 'application/bson'},
+	)
+
+	data = bson.decode(response.get_data())
+
+	assert response.status_code == 200
+	assert response.mimetype == 'application/bson'
+	assert data['result'][0]['notes'] == [{
+		'nid': 1,
+		'title': 'Note 1',
+		'nbid': 1,
+		'body': 'So Many Things',
+		'tags': ['good', 'better'],
+		'created': datetime(2019, 1, 2, 3, 4, 5),
+		'lastModified': datetime(2019, 1, 2, 3, 4, 5),
+	}]
+
+	response = app.test_client().get(
+		'/note?limit=1&fields=title',
+		headers={'Accept': 'application/bson'},
+	)
+
+	data = bson.decode(response.get_data())
+
+	assert data['result'] == [{'nid': 1, 'title': 'Note 1'}]
+	assert data['next'] is None
+
+def test_large_responses_are_compressed():
+	clear_db_and_add_notebook()
+
+	app.test_client().post(
+		'/note',
+		data=json.dumps({'title' : 'Note 1', 'nbid': 1, 'body': 'So Many Things ' * 200}),
+		content_type='application/json',
+	)
+
+	response = app.test_client().get(
+		'/note',
+		headers={'Accept-Encoding': 'gzip'},
+	)
+
+	data = json.loads(gzip.decompress(response.get_data()).decode('utf-8'))
+
+	assert response.headers['Content-Encoding'] == 'gzip'
+	assert 'Accept-Encoding' in response.headers['Vary']
+	assert data['result'][0]['body'] == 'So Many Things ' * 200
+
+	response = app.test_client().get(
+		'/note?stream=1',
+		headers={'Accept-Encoding': 'gzip'},
+	)
+
+	data = json.loads(gzip.decompress(response.get_data()).decode('utf-8'))
+
+	assert response.headers['Content-Encoding'] == 'gzip'
+	assert data['result'][0]['nid'] == 1
+
+	response = app.test_client().get(
+		'/notebook',
+		headers={'Accept-Encoding': 'gzip'},
+	)
+
+	assert 'Content-Encoding' not in response.headers
+	assert json.loads(response.get_data(as_text=True))['result'][0]['noteCount'] == 1
+
+def test_metrics():
+	clear_db_and_add_notebook_and_note()
+
+	app.test_client().get(
+		'/note/1',
+		content_type='application/json',
+	)
+	response = app.test_client().get('/metrics')
+
+	lines = response.get_data(as_text=True).splitlines()
+
+	assert response.status_code == 200
+	assert response.mimetype == 'text/plain'
+	assert any(line.startswith('nevernote_requests_total{method="GET",route="/note/<int:nid>",status="200"}') for line in lines)
+	assert 'nevernote_request_db_commands_bucket{method="GET",route="/note/<int:nid>",le="0"} 0' in lines
+	assert any(line.startswith('nevernote_db_command_duration_seconds_count{command="find"}') for line in lines)
+
+def test_note_changes():
+	with freeze_time('2019-01-02 03:04:05'):
+		clear_db_and_add_notebook_and_note()
+		app.test_client().post(
+			'/note',
+			data=json.dumps({'title' : 'Note 2', 'nbid': 1}),
+			content_type='application/json',
+		)
+
+	response = app.test_client().get(
+		'/note/changes?fields=title',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert response.status_code == 200
+	assert data['result'] == [{'nid': 1, 'title': 'Note 1'}, {'nid': 2, 'title': 'Note 2'}]
+	assert data['deleted'] == []
+	assert data['more'] is False
+	token = data['next']
+
+	with freeze_time('2019-01-03 03:04:05'):
+		app.test_client().put(
+			'/note/2',
+			data=json.dumps({'title' : 'Edited Note 2'}),
+			content_type='application/json',
+		)
+		app.test_client().delete(
+			'/note/1',
+			content_type='application/json',
+		)
+
+	response = app.test_client().get(
+		'/note/changes?fields=title&since={}'.format(token),
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'] == [{'nid': 2, 'title': 'Edited Note 2'}]
+	assert data['deleted'] == [1]
+	assert data['next'] > token
+
+	response = app.test_client().get(
+		'/note/changes?since={}'.format(data['next']),
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'] == []
+	assert data['deleted'] == []
+
+def test_note_changes_keep_recent_changes_after_the_token():
+	clear_db_and_add_notebook_and_note()
+
+	response = app.test_client().get(
+		'/note/changes',
+		content_type='application/json',
+	)
+
+	data = json.loads(response.get_data(as_text=True))
+
+	assert data['result'][0]['nid'] == 1
+	assert data['next'] == 0
+
+def test_backfill_change_seqs_numbers_notes_without_one():
+	clear_db_and_add_notebook_and_note()
+	notes.update_many({}, {'$unset': {'seq': ''}})
+
+	response = app.test_client().get(
+		'/note/changes',
+		content_type='application/json',
+	)
+
+	assert json.loads(response.get_data(as_text=True))['result'] == []
+
+	assert backfill_change_seqs(batch_size=1) == 1
+	assert backfill_change_seqs() == 0
+
+	response = app.test_client().get(
+		'/note/changes',
+		content_type='application/json',
+	)
+
+	assert json.loads(response.get_data(as_text=True))['result'][0]['nid'] == 1
+
+def test_change_seqs_start_on_a_database_without_them():
+	clear_db_and_add_notebook_and_note()
+	notes.update_many({}, {'$unset': {'seq': ''}})
+	counters.delete_one({'_id': 'seq'})
+	change_seqs.reset()
+
+	response = app.test_client().post(
+		'/note',
+		data=json.dumps({'title' : 'Note 2', 'nbid': 1}),
+		content_type='application/json',
+	)
+
+	assert response.status_code == 200
+	assert backfill_change_seqs() == 1
+	assert [(n['nid'], n['seq']) for n in notes.find().sort('nid', 1)] == [(1, 2), (2, 1)]
+
+def test_note_changes_refuse_tokens_older_than_the_purged_deletions():
+	with freeze_time('2019-01-02 03:04:05'):
+		clear_db_and_add_notebook_and_note()
+		app.test_client().delete(
+			'/note/1',
+			content_type='application/json',
+		)
+	app.test_client().post(
+		'/note',
+		data=json.dumps({'title' : 'Note 2', 'nbid': 1}),
+		content_type='application/json',
+	)
+	app.test_client().delete(
+		'/note/2',
+		content_type='application/json',
+	)
+
+	assert purge_tombstones() == 1
+	assert purge_tombstones() == 0
+	assert [d['nid'] for d in deleted_notes.find()] == [2]
+
+	response = app.test_client().get(
+		'/note/changes?since=1',
+		content_type='application/json',
+	)
+
+	assert response.status_code == 410
+
+	response = app.test_client().get(
+		'/note/changes?since=2',
+		content_type='application/json',
+	)
+
+	assert response.status_code == 200
+
+def run(coroutine):
+	loop = asyncio.new_event_loop()
+	try:
+		return loop.run_until_complete(coroutine)
+	finally:
+		loop.close()
+
+def test_event_bus_sends_events_to_the_notebook_subscribers():
+	async def check():
+		bus = EventBus(queue_size=1)
+		subscription = bus.subscribe(1)
+		other = bus.subscribe(2)
+
+		bus.publish({'type': 'delete_note', 'nbid': 1, 'nid': 1, 'seq': 1})
+
+		assert await subscription.get(0) == {'type': 'delete_note', 'nbid': 1, 'nid': 1, 'seq': 1}
+		assert await other.get(0) is None
+
+		bus.publish({'type': 'delete_note', 'nbid': 1, 'nid': 2, 'seq': 2})
+		bus.publish({'type': 'delete_note', 'nbid': 1, 'nid': 3, 'seq': 3})
+
+		assert subscription.closed
+
+		bus.unsubscribe(subscription)
+		bus.publish({'type': 'delete_note', 'nbid': 1, 'nid': 4, 'seq': 4})
+
+		assert await subscription.get(0) == {'type': 'delete_note', 'nbid': 1, 'nid': 2, 'seq': 2}
+		assert await subscription.get(0) is None
+
+	run(check())
+
+def test_change_stream_failures_are_logged_once():
+	messages = []
+
+	class Logger(object):
+		def warning(self, message, *args):
+			messages.append(message % args)
+
+	class Collection(object):
+		def watch(self, *args, **kwargs):
+			raise PyMongoError('The $changeStream stage is only supported on replica sets')
+
+	async def watch():
+		feed = create_feed('changestream', EventBus(), NOTE_FIELDS, Logger())
+		feed.retry_seconds = 0
+		task = asyncio.ensure_future(feed.watch({'notes': Collection()}, 'notes', []))
+		await asyncio.sleep(0.05)
+		task.cancel()
+		await asyncio.wait([task])
+
+	run(watch())
+
+	assert messages == ['change stream on notes failed, retrying every 0 s: The $changeStream stage is only supported on replica sets']
+
+def test_note_events_stream_as_server_sent_events():
+	pytest.importorskip('motor')
+	pytest.importorskip('starlette')
+	import asgi
+
+	async def connected():
+		return False
+
+	async def read():
+		subscription = asgi.event_bus.subscribe(1)
+		frames = asgi.stream_events(subscription, connected)
+		first = await frames.__anext__()
+		asgi.event_bus.publish({'type': 'delete_note', 'nbid': 1, 'nid': 1, 'seq': 5})
+		second = await frames.__anext__()
+		await frames.aclose()
+		return first, second.decode('utf-8')
+
+	first, second = run(read())
+
+	assert first == b': connected\n\n'
+	assert second.split('\n')[:2] == ['id: 5', 'event: delete_note']
+	assert json.loads(second.split('\n')[2][len('data: '):]) == {'type': 'delete_note', 'nbid': 1, 'nid': 1, 'seq': 5}
+	assert 1 not in asgi.event_bus.subscriptions
+
+def test_note_events_are_published_by_the_async_routes(monkeypatch):
+	pytest.importorskip('motor')
+	pytest.importorskip('starlette')
+	from starlette.testclient import TestClient
+	import asgi
+
+	monkeypatch.setattr(asgi, 'events', create_feed('local', asgi.event_bus, NOTE_FIELDS, app.logger))
+	clear_db_and_add_notebook()
+	subscription = asgi.event_bus.subscribe(1)
+
+	try:
+		with TestClient(asgi.app) as client:
+			client.post('/note', json={'title' : 'Note 1', 'nbid': 1, 'tags': ['tag1']})
+			client.put('/note/1', json={'title': 'Edited Note 1'})
+			client.delete('/note/1')
+
+			assert client.get('/note/events').status_code == 400
+			assert client.get('/note/events?nbid=2').status_code == 204
+	finally:
+		asgi.event_bus.unsubscribe(subscription)
+
+	events = [subscription.events.get_nowait() for i in range(3)]
+
+	assert [event['type'] for event in events] == ['post_note', 'edit_note', 'delete_note']
+	assert events[0]['note']['title'] == 'Note 1'
+	assert events[1]['note']['title'] == 'Edited Note 1'
+	assert events[2] == {'type': 'delete_note', 'nbid': 1, 'nid': 1, 'seq': events[2]['seq']}
+	assert events[0]['seq'] < events[1]['seq'] < events[2]['seq']
+
+def test_slow_commands_are_logged_without_their_documents():
+	messages = []
+
+	class Logger(object):
+		def warning(self, message, *args):
+			messages.append(message % args)
+
+	stats = CommandStats(Logger(), slow_ms=0)
+	for name, command in (
+			('insert', {'insert': 'notes', 'documents': [{'nid': 1, 'body': 'Secret body'}, {'nid': 2, 'body': 'Secret body'}]}),
+			('find', {'find': 'notes', 'filter': {'nbid': 1, 'title': 'Secret title', 'nid': {'$gt': 5}}})):
+		stats.started(SimpleNamespace(command_name=name, command=command))
+		stats.succeeded(SimpleNamespace(command_name=name, duration_micros=1500))
+
+	assert messages == [
+		'slow insert on notes took 1.5 ms: 2 documents',
+		"slow find on notes took 1.5 ms: {'nbid': '?', 'title': '?', 'nid': {'$gt': '?'}}",
+	]
+
+def test_bench_suite_runs_every_route():
+	pytest.importorskip('requests')
+	import bench
+
+	clear_db()
+	ensure_indexes()
+
+	results = bench.run_suite(2, notebook_count=2, note_count=5)
+
+	assert set(results) == set(name for name, route in bench.SUITE) | {'dataset'}
+	assert all(results[name]['requests'] == 2 for name, route in bench.SUITE)
+	assert notebooks.count_documents({}) == 0